@@ -9,7 +9,87 @@ from transformers import AutoTokenizer, AutoModel
 from pathlib import Path
 import re
 from typing import Dict, Any, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from hashlib import blake2b
 import json
+import os
+import threading
+
+
+# сколько последних ml ответов держим в памяти
+ML_CACHE_SIZE = 1024
+# короче этого (после strip) bert не запускаем, там нечего классифицировать
+ML_MIN_TEXT_LENGTH = 32
+# сколько символов отдаем токенизатору: с запасом на 512 токенов,
+# дальше режет сам токенизатор (truncation=True)
+ML_TEXT_SLICE = 2000
+
+# таблицы для str.translate: один проход вместо цепочки .replace()
+_VENDOR_STRIP = str.maketrans('', '', '«»"')
+_AMOUNT_FIX = str.maketrans({',': '.', ' ': None})
+
+# Расширенный список стоп-слов для extract_key_value_pairs (убираем мусор)
+KV_STOP_KEYS = {
+    "ПРИЗНАК", "РАСЧЕТ", "ПРЕДМЕТА", "ЛИЦЕНЗИЯ", "БАНКА", "РОССИИ",
+    "ФЕДЕРАЦИИ", "ОКРУГУ", "СООБЩАЕТ", "БЫЛА", "СОВЕРШЕНА", "ПО",
+    "ОПЕРАЦИЯ", "КАРТЕ", "ВЛАДЕЛЬЦЕМ", "КОТОРОЙ", "ЯВЛЯЕТСЯ"
+}
+
+# Полезные ключи (белый список)
+KV_USEFUL_KEYS = {
+    "ФН", "ФД", "ФПД", "РН ККТ", "СМЕНА", "ЧЕК", "КАССИР",
+    "АДРЕС", "МЕСТО", "САЙТ", "КПП", "БИК", "СЧЕТ",
+    "ТОВАР", "УСЛУГА", "СНО", "СИСТЕМА НАЛОГООБЛОЖЕНИЯ"
+}
+
+# "есть ли хоть одно слово из набора в ключе" одним поиском вместо any(...)
+_KV_STOP_RE = re.compile('|'.join(map(re.escape, sorted(KV_STOP_KEYS))))
+_KV_USEFUL_RE = re.compile('|'.join(map(re.escape, sorted(KV_USEFUL_KEYS))))
+
+
+# поля classifier в порядке выходов головы
+ML_FIELDS = ['inn', 'total', 'date', 'vendor']
+
+
+class ReceiptClassifier(nn.Module):
+    """classifier для инференса, такой же как при обучении (train_few_shot_model.py)"""
+    
+    def __init__(self, bert_model: nn.Module, pooling: str = 'pooler'):
+        super().__init__()
+        # bert уже загружен и заморожен в HybridBERTExtractor._load_bert,
+        # второй раз с диска его не тянем
+        self.bert = bert_model
+        # 'cls' - скрытое состояние [CLS] (новые чекпоинты), 'pooler' - pooler_output (старые)
+        self.pooling = pooling
+        
+        hidden_size = self.bert.config.hidden_size
+        # одна голова [hidden -> 4] в порядке ML_FIELDS
+        self.head = nn.Linear(hidden_size, len(ML_FIELDS))
+        self.dropout = nn.Dropout(0.3)
+    
+    def forward(self, input_ids, attention_mask):
+        """вероятности полей [batch, 4] в порядке ML_FIELDS"""
+        outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
+        if self.pooling == 'cls':
+            pooled_output = outputs.last_hidden_state[:, 0]
+        else:
+            pooled_output = outputs.pooler_output
+        x = self.dropout(pooled_output)
+        return torch.sigmoid(self.head(x))
+    
+    @staticmethod
+    def upgrade_state_dict(state_dict: Dict[str, Any]) -> Dict[str, Any]:
+        """старый чекпоинт с четырьмя головами has_* -> одна голова head"""
+        legacy = ['has_inn', 'has_total', 'has_date', 'has_vendor']
+        if f'{legacy[0]}.weight' not in state_dict:
+            return state_dict
+        
+        state_dict = dict(state_dict)
+        state_dict['head.weight'] = torch.cat([state_dict.pop(f'{name}.weight') for name in legacy], dim=0)
+        state_dict['head.bias'] = torch.cat([state_dict.pop(f'{name}.bias') for name in legacy], dim=0)
+        return state_dict
 
 
 class HybridBERTExtractor:
@@ -20,24 +100,134 @@ class HybridBERTExtractor:
     3. Confidence scoring → комбинирует результаты
     """
     
-    def __init__(self):
+    def __init__(self, quantize: Optional[bool] = None):
         self.model_name = "DeepPavlov/rubert-base-cased"
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         
+        # int8 квантизация bert на cpu (отключается HYBRID_BERT_QUANTIZE=0)
+        if quantize is None:
+            quantize = os.environ.get("HYBRID_BERT_QUANTIZE", "1") != "0"
+        self.quantize = quantize and self.device.type == 'cpu'
+        self._autocast_dtype = self._pick_autocast_dtype()
+        
         # основные компоненты
         self.tokenizer = None
         self.bert = None
         self.classifier = None
         self.ml_enabled = False
+        self._ml_executor = None
+        
+        # LRU кэш ml confidence: хэш обрезанного текста -> scores
+        self._ml_cache: "OrderedDict[bytes, Dict[str, float]]" = OrderedDict()
+        self._ml_cache_lock = threading.Lock()
         
         print(f"[HYBRID] инициализация гибридной модели...")
         print(f"[HYBRID] устройство: {self.device}")
         
+        # regex компилируем один раз, а не на каждый predict
+        self._compile_patterns()
+        
         # грузим bert и tokenizer
         self._load_bert()
         
         # пробуем подхватить обученный classifier
         self._load_classifier()
+        
+        # квантуем после загрузки весов classifier (ключи state_dict должны совпасть),
+        # bert общий, поэтому квантуется один раз
+        if self.bert is not None:
+            self.bert = self._quantize(self.bert)
+            if self.classifier is not None:
+                self.classifier.bert = self.bert
+        
+        # bert считаем в отдельном потоке, пока основной поток гоняет regex
+        # (torch отпускает GIL внутри своих C++ ядер)
+        if self.ml_enabled:
+            self._ml_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hybrid-ml")
+    
+    def _pick_autocast_dtype(self) -> Optional[torch.dtype]:
+        """
+        тип для autocast при инференсе: bf16/fp16 на gpu, на cpu оставляем fp32
+        (без нативного bf16 на процессоре autocast только замедляет)
+        """
+        if self.device.type != 'cuda':
+            return None
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    
+    def _autocast(self):
+        """autocast контекст для forward pass (или пустой, если не поддерживается)"""
+        if self._autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self._autocast_dtype)
+    
+    def _compile_patterns(self):
+        """компилирует все regex, которые используются в extract_* методах"""
+        # ИНН (10 или 12 цифр)
+        # поля ищутся отдельными search, а не одной альтернативой: совпадения разных полей
+        # могут пересекаться ("14:19.01.02.2024" - время и дата), и общий проход
+        # съел бы чужое первое совпадение
+        self._inn_re = re.compile(r'\bИНН[:\s]*(\d{10}|\d{12})\b', re.IGNORECASE)
+        # Дата: полный год важнее короткого
+        self._date_res = [re.compile(p) for p in [
+            r'\b(\d{2}[.]\d{2}[.]\d{4})\b',
+            r'\b(\d{2}[.]\d{2}[.]\d{2})\b',
+        ]]
+        # Время: с секундами важнее HH:MM
+        self._time_res = [re.compile(p) for p in [
+            r'\b(\d{2}:\d{2}:\d{2})\b',
+            r'\b(\d{2}:\d{2})\b',
+        ]]
+        
+        # Сумма (улучшенный алгоритм для МИЛЛИОНОВ, чеков и банковских операций)
+        # каждый вариант отдельным паттерном: нужен максимум по совпадениям ВСЕХ вариантов,
+        # а общая альтернатива съедает текст одной веткой (например "12 000\n7 500,00"
+        # ветка миллионов забирает через перенос строки, и целая сумма теряется)
+        kw_base = r'ИТОГО?|СУММА|ВСЕГО|Итого?'
+        kw_pay = r'К оплате|Всего к оплате|Сумма заказа'
+        amount = r'(?:\d{1,3}[\s,])*\d+[.,]\d{2}'
+        self._total_res = [re.compile(p, re.IGNORECASE) for p in [
+            # Чеки с миллионами (1 659 649,00)
+            rf'(?:{kw_base}|TOTAL|{kw_pay})[:\s=]*((?:\d{{1,3}}[\s]\d{{3}}[\s]\d{{3}}|[\d\s]{{1,15}})[.,]\d{{2}})\s*(?:₽|руб|RUB|Р|P)?',
+            # Обычные чеки
+            rf'(?:{kw_base}|TOTAL|Сумма заказа)[:\s=]*({amount})\s*(?:₽|руб|RUB|Р|P)?',
+            rf'(?:Электронный\s+платеж|Оплата)[:\s]*({amount})',
+            # Банковские операции
+            rf'(?:Сумма в валюте карты|Сумма операции|К оплате)[:\s]*({amount})',
+            # Суммы в формате "150,00 RUB" на отдельной строке
+            rf'(?:^|\n)\s*({amount})\s*(?:RUB|руб|₽|Р)\s*(?:\n|$)',
+            r'((?:\d{1,3}[\s,])+\d{2,}[.,]\d{2})\s*(?:₽|руб|RUB)',
+            # Чеки/квитанции без копеек: "Итого 2 600 ₽" (OCR может давать "i" вместо "₽")
+            rf'(?:{kw_base}|{kw_pay})[:\s=]*((?:\d{{1,3}}[\s]\d{{3}}|\d{{2,6}}))\s*(?:₽|руб|RUB|Р|P|i)?',
+        ]]
+        
+        self._email_re = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+        self._phone_re = re.compile(r'\+?[78][\s-]?\(?\d{3}\)?[\s-]?\d{3}[\s-]?\d{2}[\s-]?\d{2}')
+        
+        self._vendor_res = [
+            re.compile(r'((?:ООО|ИП|ПАО|АО|ЗАО)\s+["\"]?[А-ЯЁа-яё\s\-]{3,50}["\"]?)'),
+        ]
+        
+        self._ofd_res = [re.compile(p, re.IGNORECASE) for p in [
+            r'ФНС[:\s]+([a-z0-9\-\.]+\.[a-z]{2,})',
+            r'((?:ofd|nalog|taxcom|platformaofd)\.[a-z]{2,})',
+        ]]
+        
+        # пары ключ-значение для extract_key_value_pairs
+        self._kv_res = [re.compile(p, re.IGNORECASE) for p in [
+            # Короткие аббревиатуры с номерами
+            r"((?:ФН|ФД|ФПД|РН ККТ|БИК|КПП))[:\s№]+(\d+)",
+            # Кассовый чек с номером
+            r"(Кассовый\s+чек)\s+№\s*(\d+)",
+            # Полезные поля
+            r"((?:СМЕНА|ЧЕК|КАССИР|АДРЕС|МЕСТО|САЙТ|СНО))[:\s№]+([^\n]{3,60}?)(?:\n|$)",
+        ]]
+        self._ws_re = re.compile(r'\s+')
+    
+    def _quantize(self, module: nn.Module) -> nn.Module:
+        """динамическая int8 квантизация linear слоев (только для cpu), головы classifier не трогаем"""
+        if not self.quantize:
+            return module
+        return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
     
     def _load_bert(self):
         """грузит bert модель"""
@@ -51,7 +241,7 @@ class HybridBERTExtractor:
             for param in self.bert.parameters():
                 param.requires_grad = False
             
-            print(f"[OK] BERT загружен: {self.model_name}")
+            print(f"[OK] BERT загружен: {self.model_name}{' (int8)' if self.quantize else ''}")
         except Exception as e:
             print(f"[WARNING] Не удалось загрузить BERT: {e}")
     
@@ -64,39 +254,35 @@ class HybridBERTExtractor:
                 print(f"[INFO] Обученный classifier не найден: {model_path}")
                 return
             
-            # локальный класс, такой же как при обучении
-            class ReceiptClassifier(nn.Module):
-                def __init__(self, bert_model_name: str):
-                    super().__init__()
-                    self.bert = AutoModel.from_pretrained(bert_model_name)
-                    for param in self.bert.parameters():
-                        param.requires_grad = False
-                    
-                    hidden_size = self.bert.config.hidden_size
-                    self.has_inn = nn.Linear(hidden_size, 1)
-                    self.has_total = nn.Linear(hidden_size, 1)
-                    self.has_date = nn.Linear(hidden_size, 1)
-                    self.has_vendor = nn.Linear(hidden_size, 1)
-                    self.dropout = nn.Dropout(0.3)
-                
-                def forward(self, input_ids, attention_mask):
-                    outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
-                    pooled_output = outputs.pooler_output
-                    x = self.dropout(pooled_output)
-                    
-                    return {
-                        'has_inn': torch.sigmoid(self.has_inn(x)),
-                        'has_total': torch.sigmoid(self.has_total(x)),
-                        'has_date': torch.sigmoid(self.has_date(x)),
-                        'has_vendor': torch.sigmoid(self.has_vendor(x))
-                    }
-            
-            # создаем модель
-            self.classifier = ReceiptClassifier(self.model_name)
+            if self.bert is None:
+                print(f"[INFO] BERT не загружен, classifier пропускаем")
+                return
             
             # загружаем веса с диска
             checkpoint = torch.load(model_path, map_location=self.device)
-            self.classifier.load_state_dict(checkpoint['model_state_dict'])
+            
+            # создаем модель поверх уже загруженного bert
+            # (чекпоинты без 'pooling' обучены на pooler_output)
+            pooling = checkpoint.get('pooling', 'pooler')
+            self.classifier = ReceiptClassifier(self.bert, pooling=pooling)
+            
+            if 'head_state_dict' in checkpoint:
+                # новый формат: только голова, bert берется из hub
+                bert_model_name = checkpoint.get('bert_model_name', self.model_name)
+                if bert_model_name != self.model_name:
+                    self.classifier = None
+                    print(f"[WARNING] classifier обучен на {bert_model_name}, а загружен {self.model_name}")
+                    print(f"[INFO] Используется только regex")
+                    return
+                self.classifier.head.load_state_dict(checkpoint['head_state_dict'])
+                if pooling == 'cls':
+                    # голове pooler не нужен: BertModel пропускает его, если pooler = None
+                    self.bert.pooler = None
+            else:
+                # старый формат: полный state_dict вместе с bert
+                self.classifier.load_state_dict(
+                    ReceiptClassifier.upgrade_state_dict(checkpoint['model_state_dict'])
+                )
             self.classifier.to(self.device)
             self.classifier.eval()
             
@@ -118,32 +304,45 @@ class HybridBERTExtractor:
         if not self.ml_enabled or not self.bert or not self.classifier:
             return {}
         
+        # пустой/почти пустой текст (например, неудачный OCR) - bert не нужен
+        if len(text.strip()) < ML_MIN_TEXT_LENGTH:
+            return {}
+        
+        # bert видит только text[:ML_TEXT_SLICE], по нему и кэшируем
+        ml_text = text[:ML_TEXT_SLICE]
+        key = blake2b(ml_text.encode('utf-8', 'ignore'), digest_size=16).digest()
+        with self._ml_cache_lock:
+            cached = self._ml_cache.get(key)
+            if cached is not None:
+                self._ml_cache.move_to_end(key)
+                return dict(cached)
+        
         try:
-            # Токенизация
+            # Токенизация без паддинга до 512: для одного текста attention_mask
+            # и так из единиц, bert считает только реальные токены
             encoding = self.tokenizer(
-                text[:512],
+                ml_text,
                 max_length=512,
-                padding='max_length',
                 truncation=True,
                 return_tensors='pt'
             ).to(self.device)
             
             # Forward pass
-            with torch.no_grad():
+            with torch.inference_mode(), self._autocast():
                 outputs = self.classifier(
                     encoding['input_ids'],
                     encoding['attention_mask']
                 )
             
-            # Извлекаем confidence scores
-            confidence = {
-                'inn': outputs['has_inn'].item(),
-                'total': outputs['has_total'].item(),
-                'date': outputs['has_date'].item(),
-                'vendor': outputs['has_vendor'].item()
-            }
+            # Извлекаем confidence scores ([1, 4] -> словарь)
+            confidence = dict(zip(ML_FIELDS, outputs[0].tolist()))
+            
+            with self._ml_cache_lock:
+                self._ml_cache[key] = confidence
+                if len(self._ml_cache) > ML_CACHE_SIZE:
+                    self._ml_cache.popitem(last=False)
             
-            return confidence
+            return dict(confidence)
             
         except Exception as e:
             print(f"[WARNING] ML confidence failed: {e}")
@@ -156,88 +355,63 @@ class HybridBERTExtractor:
         result = {}
         
         # ИНН (10 или 12 цифр)
-        inn_match = re.search(r'\bИНН[:\s]*(\d{10}|\d{12})\b', text, re.IGNORECASE)
+        inn_match = self._inn_re.search(text)
         if inn_match:
             result['inn'] = inn_match.group(1)
         
         # Дата
-        date_patterns = [
-            r'\b(\d{2}[.]\d{2}[.]\d{4})\b',
-            r'\b(\d{2}[.]\d{2}[.]\d{2})\b',
-        ]
-        for pattern in date_patterns:
-            match = re.search(pattern, text)
+        for date_re in self._date_res:
+            match = date_re.search(text)
             if match:
                 result['date'] = match.group(1)
                 break
         
         # Время
-        time_match = re.search(r'\b(\d{2}:\d{2}:\d{2})\b', text)
-        if time_match:
-            result['time'] = time_match.group(1)
-        elif re.search(r'\b(\d{2}:\d{2})\b', text):
-            result['time'] = re.search(r'\b(\d{2}:\d{2})\b', text).group(1)
+        for time_re in self._time_res:
+            match = time_re.search(text)
+            if match:
+                result['time'] = match.group(1)
+                break
         
         # Сумма (улучшенный алгоритм для МИЛЛИОНОВ, чеков и банковских операций)
-        all_totals = []
-        total_patterns = [
-            # Чеки с миллионами (1 659 649,00)
-            r'(?:ИТОГО?|СУММА|TOTAL|ВСЕГО|Итого?|К оплате|Всего к оплате|Сумма заказа)[:\s=]*((?:\d{1,3}[\s]\d{3}[\s]\d{3}|[\d\s]{1,15})[.,]\d{2})\s*(?:₽|руб|RUB|Р|P)?',
-            # Обычные чеки
-            r'(?:ИТОГО?|СУММА|TOTAL|ВСЕГО|Итого?|Сумма заказа)[:\s=]*((?:\d{1,3}[\s,])*\d+[.,]\d{2})\s*(?:₽|руб|RUB|Р|P)?',
-            r'(?:Электронный\s+платеж|Оплата)[:\s]*((?:\d{1,3}[\s,])*\d+[.,]\d{2})',
-            # Банковские операции
-            r'(?:Сумма в валюте карты|Сумма операции|К оплате)[:\s]*((?:\d{1,3}[\s,])*\d+[.,]\d{2})',
-            # Суммы в формате "150,00 RUB" на отдельной строке
-            r'(?:^|\n)\s*((?:\d{1,3}[\s,])*\d+[.,]\d{2})\s*(?:RUB|руб|₽|Р)\s*(?:\n|$)',
-            r'((?:\d{1,3}[\s,])+\d{2,}[.,]\d{2})\s*(?:₽|руб|RUB)',
-            # Чеки/квитанции без копеек: "Итого 2 600 ₽" (OCR может давать "i" вместо "₽")
-            r'(?:ИТОГО?|СУММА|ВСЕГО|Итого?|К оплате|Всего к оплате|Сумма заказа)[:\s=]*((?:\d{1,3}[\s]\d{3}|\d{2,6}))\s*(?:₽|руб|RUB|Р|P|i)?',
-        ]
-        
-        for pattern in total_patterns:
-            for match in re.finditer(pattern, text, re.IGNORECASE):
-                value = match.group(1).replace(',', '.').replace(' ', '')
+        # держим только текущий максимум, список кандидатов не нужен
+        best_total = None
+        for total_re in self._total_res:
+            for match in total_re.finditer(text):
+                value = match.group(1).translate(_AMOUNT_FIX)
                 try:
                     num_val = float(value)
-                    if num_val > 50:
-                        all_totals.append((num_val, value))
+                    if num_val > 50 and (best_total is None or (num_val, value) > best_total):
+                        best_total = (num_val, value)
                 except:
                     pass
         
-        if all_totals:
-            all_totals.sort(reverse=True)
-            result['total'] = all_totals[0][1]
+        if best_total:
+            result['total'] = best_total[1]
         
-        # Email
-        email_match = re.search(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', text)
-        if email_match:
-            result['email'] = email_match.group(0)
+        # Email (без '@' искать нечего)
+        if '@' in text:
+            email_match = self._email_re.search(text)
+            if email_match:
+                result['email'] = email_match.group(0)
         
         # Телефон
-        phone_match = re.search(r'\+?[78][\s-]?\(?\d{3}\)?[\s-]?\d{3}[\s-]?\d{2}[\s-]?\d{2}', text)
+        phone_match = self._phone_re.search(text)
         if phone_match:
             result['phone'] = phone_match.group(0)
         
         # Поставщик
-        vendor_patterns = [
-            r'((?:ООО|ИП|ПАО|АО|ЗАО)\s+["\"]?[А-ЯЁа-яё\s\-]{3,50}["\"]?)',
-        ]
-        for pattern in vendor_patterns:
-            match = re.search(pattern, text)
+        for vendor_re in self._vendor_res:
+            match = vendor_re.search(text)
             if match:
-                vendor = match.group(1).strip().replace('"', '').replace('"', '').strip()
+                vendor = match.group(1).strip().translate(_VENDOR_STRIP).strip()
                 if len(vendor) > 5:
                     result['vendor'] = vendor
                     break
         
         # ОФД
-        ofd_patterns = [
-            r'ФНС[:\s]+([a-z0-9\-\.]+\.[a-z]{2,})',
-            r'((?:ofd|nalog|taxcom|platformaofd)\.[a-z]{2,})',
-        ]
-        for pattern in ofd_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
+        for ofd_re in self._ofd_res:
+            match = ofd_re.search(text)
             if match:
                 result['ofd'] = match.group(1)
                 break
@@ -248,42 +422,15 @@ class HybridBERTExtractor:
         """Извлекает произвольные пары ключ-значение (только полезные!)"""
         pairs = {}
         
-        # Расширенный список стоп-слов (убираем мусор)
-        stop_keys = {
-            "ПРИЗНАК", "РАСЧЕТ", "ПРЕДМЕТА", "ЛИЦЕНЗИЯ", "БАНКА", "РОССИИ",
-            "ФЕДЕРАЦИИ", "ОКРУГУ", "СООБЩАЕТ", "БЫЛА", "СОВЕРШЕНА", "ПО",
-            "ОПЕРАЦИЯ", "КАРТЕ", "ВЛАДЕЛЬЦЕМ", "КОТОРОЙ", "ЯВЛЯЕТСЯ"
-        }
-        
-        # Полезные ключи (белый список)
-        useful_keys = {
-            "ФН", "ФД", "ФПД", "РН ККТ", "СМЕНА", "ЧЕК", "КАССИР",
-            "АДРЕС", "МЕСТО", "САЙТ", "КПП", "БИК", "СЧЕТ",
-            "ТОВАР", "УСЛУГА", "СНО", "СИСТЕМА НАЛОГООБЛОЖЕНИЯ"
-        }
-        
-        patterns = [
-            # Короткие аббревиатуры с номерами
-            r"((?:ФН|ФД|ФПД|РН ККТ|БИК|КПП))[:\s№]+(\d+)",
-            # Кассовый чек с номером
-            r"(Кассовый\s+чек)\s+№\s*(\d+)",
-            # Полезные поля
-            r"((?:СМЕНА|ЧЕК|КАССИР|АДРЕС|МЕСТО|САЙТ|СНО))[:\s№]+([^\n]{3,60}?)(?:\n|$)",
-        ]
-        
-        for pattern in patterns:
-            for match in re.finditer(pattern, text, re.IGNORECASE):
-                key = re.sub(r'\s+', ' ', match.group(1).strip().upper())
-                value = re.sub(r'\s+', ' ', match.group(2).strip())
+        for kv_re in self._kv_res:
+            for match in kv_re.finditer(text):
+                key = self._ws_re.sub(' ', match.group(1).strip().upper())
+                value = self._ws_re.sub(' ', match.group(2).strip())
                 
                 # Фильтры
                 if len(value) < 2 or len(value) > 100:
                     continue
                 
-                # Проверяем стоп-слова
-                if any(stop in key for stop in stop_keys):
-                    continue
-                
                 # Проверяем что это не часть предложения
                 if value.count(' ') > 10:  # Слишком много слов = предложение
                     continue
@@ -292,8 +439,12 @@ class HybridBERTExtractor:
                 if value.split()[-1].lower() in ['в', 'по', 'на', 'от', 'для', 'с', 'к']:
                     continue
                 
+                # Проверяем стоп-слова (после дешевых проверок)
+                if _KV_STOP_RE.search(key):
+                    continue
+                
                 # Добавляем только если ключ полезный
-                if any(useful in key for useful in useful_keys):
+                if _KV_USEFUL_RE.search(key):
                     pairs[key] = value
         
         return pairs
@@ -304,8 +455,10 @@ class HybridBERTExtractor:
         """
         print(f"[HYBRID] Обработка документа ({len(text)} символов)...")
         
-        # 1. ML confidence scores
-        ml_confidence = self.get_ml_confidence(text)
+        # 1. ML confidence scores (в фоне, если ml включен)
+        ml_future = None
+        if self._ml_executor is not None:
+            ml_future = self._ml_executor.submit(self.get_ml_confidence, text)
         
         # 2. Regex extraction
         result = self.extract_with_regex(text)
@@ -314,6 +467,8 @@ class HybridBERTExtractor:
         auto_extracted = self.extract_key_value_pairs(text)
         result['auto_extracted'] = auto_extracted
         
+        ml_confidence = ml_future.result() if ml_future is not None else self.get_ml_confidence(text)
+        
         # 4. Добавляем ML confidence если есть
         if ml_confidence:
             result['ml_confidence'] = ml_confidence
@@ -333,6 +488,7 @@ class HybridBERTExtractor:
             'model_type': 'Hybrid BERT + Regex',
             'approach': 'ML confidence scoring + Rule-based extraction',
             'device': str(self.device),
+            'quantized': self.quantize,
             'ml_enabled': self.ml_enabled,
             'bert_loaded': self.bert is not None,
             'classifier_trained': self.classifier is not None
@@ -345,7 +501,15 @@ if __name__ == "__main__":
     print("ТЕСТ ГИБРИДНОЙ МОДЕЛИ")
     print("="*80)
     
-    extractor = HybridBERTExtractor()
+    import argparse
+    parser = argparse.ArgumentParser(description="Тест гибридной модели")
+    parser.add_argument("--quantize", dest="quantize", action="store_true", default=None,
+                        help="int8 квантизация bert на cpu (по умолчанию включена)")
+    parser.add_argument("--no-quantize", dest="quantize", action="store_false",
+                        help="оставить bert в fp32")
+    args = parser.parse_args()
+    
+    extractor = HybridBERTExtractor(quantize=args.quantize)
     
     test_text = """
     КАССОВЫЙ ЧЕК
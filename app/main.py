@@ -1,11 +1,18 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, status
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-from typing import Dict, Any, List
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
 from app import processor
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import asyncio
+import copy
+import hashlib
 import logging
-import io
-from PIL import Image
+import orjson
+import threading
 import tempfile
 import os
 
@@ -13,12 +20,104 @@ import os
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# лимиты загрузки
+MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 мб
+UPLOAD_CHUNK_SIZE = 64 * 1024  # читаем загрузку кусками по 64 кб
+PDF_MAGIC = b'%PDF-'  # pdf всегда начинается с %pdf-
+
+# один общий пул потоков на весь процесс для cpu-тяжелого парсинга pdf,
+# семафор не дает batch запросу поставить в очередь больше задач, чем потоков
+PDF_WORKERS = os.cpu_count() or 4
+_EXECUTOR = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf-worker")
+_SEM = asyncio.Semaphore(PDF_WORKERS)
+
+# кэш результатов по sha-256 содержимого pdf (повторные загрузки того же файла)
+RESULT_CACHE_SIZE = 256
+_RESULT_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_RESULT_CACHE_LOCK = threading.Lock()
+# второй уровень кэша на диске, включается переменной окружения
+RESULT_CACHE_DIR = Path(os.environ["PDF_CACHE_DIR"]) if os.environ.get("PDF_CACHE_DIR") else None
+
+
+class UploadValidationError(Exception):
+    """загрузка не прошла проверку: пустая, не pdf или слишком большая"""
+    
+    def __init__(self, message: str, status_code: int = status.HTTP_400_BAD_REQUEST):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def remove_upload(path: str) -> None:
+    """удаляет временный файл загрузки, ошибки только логируем (повторный вызов безопасен)"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # уже удален
+    except OSError as e:
+        logger.warning(f"Не удалось удалить временный файл {path}: {e}")
+
+
+def _file_too_large(filename: Optional[str]) -> UploadValidationError:
+    logger.warning(f"Файл {filename} слишком большой: больше {MAX_FILE_SIZE} байт")
+    return UploadValidationError(
+        "Размер файла превышает 10 МБ",
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    )
+
+
+async def save_pdf_upload(file: UploadFile) -> Tuple[str, str]:
+    """
+    Стримит загрузку во временный файл кусками по UPLOAD_CHUNK_SIZE.
+    Сначала дешевые проверки: размер из заголовков (если известен) и первые
+    5 байт (magic bytes), и только потом читается остальное - с лимитом
+    размера по ходу чтения, так что плохой файл не дочитывается в память.
+    Возвращает (путь к временному файлу, sha-256 содержимого),
+    удалять файл должен вызывающий.
+    """
+    # starlette заполняет size, когда размер части известен заранее
+    size_hint = getattr(file, "size", None)
+    if size_hint is not None and size_hint > MAX_FILE_SIZE:
+        raise _file_too_large(file.filename)
+    
+    header = await file.read(len(PDF_MAGIC))
+    if not header:
+        logger.warning("Получен пустой файл")
+        raise UploadValidationError("Файл пуст")
+    if header != PDF_MAGIC:
+        logger.warning(f"Файл {file.filename} не является PDF (magic bytes проверка)")
+        logger.warning(f"Первые байты: {header}")
+        raise UploadValidationError("Файл не является PDF документом")
+    
+    fd, tmp_path = tempfile.mkstemp(suffix=".pdf")
+    size = len(header)
+    sha = hashlib.sha256(header)
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(header)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise _file_too_large(file.filename)
+                
+                tmp.write(chunk)
+                sha.update(chunk)
+        
+        logger.info(f"Обработка файла: {file.filename}, размер: {size} байт")
+        return tmp_path, sha.hexdigest()
+    
+    except BaseException:
+        remove_upload(tmp_path)
+        raise
+
+
 app = FastAPI(
     title="K-Telecom PDF Parser API",
     description="API для извлечения структурированных данных из PDF-счетов",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    # orjson быстрее stdlib json и пишет кириллицу без \u-экранирования
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -30,6 +129,85 @@ app.add_middleware(
 )
 
 
+def _cache_get(digest: str) -> Optional[Dict[str, Any]]:
+    """ищет результат сначала в памяти, потом на диске"""
+    with _RESULT_CACHE_LOCK:
+        cached = _RESULT_CACHE.get(digest)
+        if cached is not None:
+            _RESULT_CACHE.move_to_end(digest)
+            return copy.deepcopy(cached)
+    
+    if RESULT_CACHE_DIR is not None:
+        path = RESULT_CACHE_DIR / f"{digest}.json"
+        try:
+            cached = orjson.loads(path.read_bytes())
+        except (OSError, ValueError):
+            return None
+        _cache_put_memory(digest, cached)
+        return copy.deepcopy(cached)
+    
+    return None
+
+
+def _cache_put_memory(digest: str, result: Dict[str, Any]) -> None:
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE[digest] = result
+        _RESULT_CACHE.move_to_end(digest)
+        if len(_RESULT_CACHE) > RESULT_CACHE_SIZE:
+            _RESULT_CACHE.popitem(last=False)
+
+
+def _cache_put(digest: str, result: Dict[str, Any]) -> None:
+    """кладет результат в память и (если включен) на диск, запись на диск атомарная"""
+    _cache_put_memory(digest, copy.deepcopy(result))
+    
+    if RESULT_CACHE_DIR is not None:
+        try:
+            RESULT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=RESULT_CACHE_DIR, suffix=".tmp")
+        except OSError as e:
+            logger.warning(f"Не удалось записать кэш {digest}: {e}")
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps(result))
+            os.replace(tmp_name, RESULT_CACHE_DIR / f"{digest}.json")
+        except (OSError, TypeError) as e:
+            # недописанный .tmp не оставляем
+            logger.warning(f"Не удалось записать кэш {digest}: {e}")
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+
+
+def extract_invoice_data_cached(pdf_path: str, digest: str) -> Dict[str, Any]:
+    """processor.extract_invoice_data с кэшем по sha-256 содержимого (ошибки не кэшируем)"""
+    cached = _cache_get(digest)
+    if cached is not None:
+        logger.info(f"Результат взят из кэша: {digest[:12]}")
+        return cached
+    
+    result = processor.extract_invoice_data(pdf_path, verbose=False)
+    if "error" not in result:
+        _cache_put(digest, result)
+    return result
+
+
+async def extract_invoice_data_async(pdf_path: str, digest: str) -> Dict[str, Any]:
+    """
+    Асинхронная обертка: парсинг идет в общем пуле потоков (не больше PDF_WORKERS
+    одновременно), event loop в это время обслуживает другие запросы.
+    """
+    async with _SEM:
+        return await asyncio.get_running_loop().run_in_executor(
+            _EXECUTOR,
+            extract_invoice_data_cached,
+            pdf_path,
+            digest
+        )
+
+
 @app.get("/")
 def read_root():
     """простой ping эндпоинт."""
@@ -55,41 +233,29 @@ def health_check():
     }
 
 
+async def validated_pdf_upload(file: UploadFile = File(...)) -> AsyncIterator[Tuple[str, str, str]]:
+    """
+    Зависимость для эндпоинтов с одним pdf: проверяет и сохраняет загрузку,
+    отдает (имя файла, путь к временному файлу, sha-256) и удаляет файл после обработки.
+    """
+    try:
+        tmp_path, digest = await save_pdf_upload(file)
+    except UploadValidationError as e:
+        raise HTTPException(status_code=e.status_code, detail=f"Ошибка: {e}")
+    
+    try:
+        yield file.filename, tmp_path, digest
+    finally:
+        remove_upload(tmp_path)
+
+
 @app.post("/api/process_pdf/", tags=["PDF Processing"], status_code=status.HTTP_200_OK)
-async def process_pdf(file: UploadFile = File(...)) -> Dict[str, Any]:
+async def process_pdf(upload: Tuple[str, str, str] = Depends(validated_pdf_upload)) -> Dict[str, Any]:
     """принимает один pdf и возвращает распарсенный json."""
+    filename, tmp_path, digest = upload
     try:
-        # читаем весь файл в память
-        pdf_bytes = await file.read()
-        
-        # быстрые валидации
-        if len(pdf_bytes) == 0:
-            logger.warning("Получен пустой файл")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Ошибка: Файл пуст"
-            )
-        
-        # проверяем magic bytes: pdf всегда начинается с %pdf-
-        if not pdf_bytes.startswith(b'%PDF-'):
-            logger.warning(f"Файл {file.filename} не является PDF (magic bytes проверка)")
-            logger.warning(f"Первые байты: {pdf_bytes[:20]}")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Ошибка: Файл не является PDF документом"
-            )
-        
-        if len(pdf_bytes) > 10 * 1024 * 1024:  # лимит 10 мб
-            logger.warning(f"Файл слишком большой: {len(pdf_bytes)} байт")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Ошибка: Размер файла превышает 10 МБ"
-            )
-        
-        logger.info(f"Обработка файла: {file.filename}, размер: {len(pdf_bytes)} байт")
-        
-        # запускаем основной парсер
-        extracted_data = processor.extract_invoice_data(pdf_bytes, verbose=False)
+        # запускаем основной парсер (pdf читается с диска, повторы берутся из кэша)
+        extracted_data = await extract_invoice_data_async(tmp_path, digest)
         
         # смотрим нет ли ошибки
         if "error" in extracted_data:
@@ -100,10 +266,10 @@ async def process_pdf(file: UploadFile = File(...)) -> Dict[str, Any]:
             )
         
         # успешный ответ
-        logger.info(f"Файл {file.filename} успешно обработан")
+        logger.info(f"Файл {filename} успешно обработан")
         return {
             "status": "success",
-            "filename": file.filename,
+            "filename": filename,
             "data": extracted_data
         }
         
@@ -121,106 +287,141 @@ async def process_pdf(file: UploadFile = File(...)) -> Dict[str, Any]:
 
 
 @app.post("/api/process-batch/", tags=["PDF Processing"], status_code=status.HTTP_200_OK)
-async def process_pdf_batch(files: List[UploadFile] = File(...)) -> Dict[str, Any]:
+async def process_pdf_batch(files: List[UploadFile] = File(...)) -> StreamingResponse:
     """
     Принимает несколько PDF-файлов, обрабатывает их и возвращает результаты для каждого.
-    Возвращает:
+    Ответ отдается потоком по мере готовности файлов (в порядке загрузки),
+    но это все тот же один json документ:
+    - status: "completed"
+    - results: список результатов для каждого файла
     - total: общее количество файлов
     - successful: количество успешно обработанных
     - failed: количество файлов с ошибками
-    - results: список результатов для каждого файла
     """
     logger.info(f"Получено {len(files)} файлов для batch обработки")
     
-    results = []
-    successful = 0
-    failed = 0
+    async def save_one_file(file: UploadFile) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        """сохраняет загрузку на диск, возвращает (путь, sha-256, ошибка)"""
+        try:
+            tmp_path, digest = await save_pdf_upload(file)
+            return tmp_path, digest, None
+        except UploadValidationError as e:
+            return None, None, str(e)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке {file.filename}: {str(e)}")
+            return None, None, str(e)
     
     # ПАРАЛЛЕЛЬНАЯ обработка файлов
-    import asyncio
-    from concurrent.futures import ThreadPoolExecutor
-    
-    async def process_one_file(file: UploadFile) -> Dict[str, Any]:
+    async def process_one_file(filename: str, tmp_path: Optional[str],
+                               digest: Optional[str], error: Optional[str]) -> Dict[str, Any]:
         """Обработка одного файла"""
+        if error is not None:
+            return {
+                "filename": filename,
+                "status": "error",
+                "error": error
+            }
+        
         try:
-            pdf_bytes = await file.read()
-            
-            if len(pdf_bytes) == 0:
-                return {
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": "Файл пуст"
-                }
-            
-            if not pdf_bytes.startswith(b'%PDF-'):
-                return {
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": "Файл не является PDF документом"
-                }
-            
-            if len(pdf_bytes) > 10 * 1024 * 1024:
-                return {
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": "Размер файла превышает 10 МБ"
-                }
-            
-            logger.info(f"Обработка файла: {file.filename}, размер: {len(pdf_bytes)} байт")
-            
-            # Обработка в отдельном потоке для параллелизма
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as pool:
-                extracted_data = await loop.run_in_executor(
-                    pool,
-                    processor.extract_invoice_data,
-                    pdf_bytes,
-                    False
-                )
+            # Обработка в общем пуле потоков, не больше PDF_WORKERS файлов одновременно
+            extracted_data = await extract_invoice_data_async(tmp_path, digest)
             
             if "error" in extracted_data:
                 return {
-                    "filename": file.filename,
+                    "filename": filename,
                     "status": "error",
                     "error": extracted_data.get("error", "Неизвестная ошибка")
                 }
             else:
                 return {
-                    "filename": file.filename,
+                    "filename": filename,
                     "status": "success",
                     "data": extracted_data
                 }
                 
         except Exception as e:
-            logger.error(f"Ошибка при обработке {file.filename}: {str(e)}")
+            logger.error(f"Ошибка при обработке {filename}: {str(e)}")
             return {
-                "filename": file.filename,
+                "filename": filename,
                 "status": "error",
                 "error": str(e)
             }
+        finally:
+            # файл нужен только этой задаче: удаляем сразу, не дожидаясь конца ответа
+            if tmp_path is not None:
+                remove_upload(tmp_path)
+    
+    # загрузки сохраняем до ответа: после возврата StreamingResponse
+    # fastapi может уже закрыть UploadFile
+    uploads = await asyncio.gather(*[save_one_file(f) for f in files])
     
     # Обрабатываем ВСЕ файлы параллельно
-    results = await asyncio.gather(*[process_one_file(f) for f in files])
+    tasks = [
+        asyncio.ensure_future(process_one_file(f.filename, *upload))
+        for f, upload in zip(files, uploads)
+    ]
     
-    # Подсчет статистики
-    successful = sum(1 for r in results if r.get("status") == "success")
-    failed = sum(1 for r in results if r.get("status") == "error")
+    async def cleanup():
+        """
+        отменяет незаконченные задачи и удаляет временные файлы; идемпотентна.
+        вызывается и из генератора, и фоновой задачей ответа: если клиент отключился
+        до начала отдачи, генератор не стартует и его finally не выполнится
+        """
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # задача, отмененная до старта, свой файл удалить не успела
+        for tmp_path, _, _ in uploads:
+            if tmp_path is not None:
+                remove_upload(tmp_path)
     
-    logger.info(f"Batch обработка завершена: {successful} успешно, {failed} с ошибками")
+    async def stream_results():
+        successful = 0
+        failed = 0
+        try:
+            yield b'{"status":"completed","results":['
+            # ждем в порядке загрузки (бот нумерует файлы по позиции),
+            # каждый результат уходит клиенту сразу и не копится в памяти
+            for i, task in enumerate(tasks):
+                result = await task
+                if result.get("status") == "success":
+                    successful += 1
+                else:
+                    failed += 1
+                yield (b"," if i else b"") + orjson.dumps(result)
+            
+            logger.info(f"Batch обработка завершена: {successful} успешно, {failed} с ошибками")
+            yield b'],' + orjson.dumps({
+                "total": len(files),
+                "successful": successful,
+                "failed": failed
+            })[1:]
+        
+        finally:
+            # клиент мог отключиться посреди ответа
+            await cleanup()
     
-    return {
-        "status": "completed",
-        "total": len(files),
-        "successful": successful,
-        "failed": failed,
-        "results": results
-    }
+    return StreamingResponse(stream_results(), media_type="application/json",
+                             background=BackgroundTask(cleanup))
+
+
+@app.on_event("startup")
+async def warmup_model():
+    """грузим модель до первого запроса, а не внутри него"""
+    await asyncio.get_running_loop().run_in_executor(_EXECUTOR, processor.get_hybrid_model)
+
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    """гасим общий пул потоков при остановке сервиса"""
+    _EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
 
 # Обработчик глобальных исключений
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     logger.error(f"Глобальная ошибка: {str(exc)}", exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={"detail": "Внутренняя ошибка сервера"}
     )
\ No newline at end of file
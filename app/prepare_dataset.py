@@ -4,22 +4,86 @@
 
 import fitz  # чтение pdf
 from pathlib import Path
+from typing import List
+import itertools
 import json
+import logging
 from PIL import Image
 import pytesseract
+import multiprocessing
 import os
+import subprocess
+import tempfile
+
+
+# прогресс по файлам/страницам идет в лог (LOGLEVEL=INFO или DEBUG чтобы видеть),
+# сводка в конце - обычным print
+log = logging.getLogger(__name__)
+
+
+def setup_logging() -> None:
+    logging.basicConfig(
+        level=os.environ.get("LOGLEVEL", "WARNING").upper(),
+        format="%(levelname)s %(message)s"
+    )
+
+
+# orjson (есть в requirements для api) пишет json в разы быстрее, но и без него работаем
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # быстрый поиск tesseract
 if os.path.exists(r"C:\Program Files\Tesseract-OCR\tesseract.exe"):
     pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
+# tesserocr (если есть) - один загруженный tesseract на процесс вместо запуска exe на каждый файл
+try:
+    from tesserocr import PyTessBaseAPI, OEM
+except ImportError:
+    PyTessBaseAPI = None
+
+_TESS_API = None  # у каждого процесса пула свой
+
+# длинная сторона картинки для ocr, больше - уменьшаем
+OCR_MAX_SIDE = 2000
+
+# разделитель страниц для пакетного ocr (page_separator появился в tesseract 4.1,
+# в docker образе tesseract-ocr из debian - 5.x). свой маркер вместо \f по умолчанию:
+# в тексте чека он не встретится, и страницы однозначно сопоставляются с файлами
+PAGE_SEPARATOR = "@@tesseract-page-break@@"
+
+
+def init_worker():
+    """initializer пула: поднимаем tesserocr один раз на процесс"""
+    global _TESS_API
+    # при spawn (windows) дочерний процесс не видит настройку логов из main
+    setup_logging()
+    if PyTessBaseAPI is not None:
+        try:
+            # только LSTM (--oem 1), как в processor.py и в pytesseract вызовах для картинок;
+            # psm задается в ocr() на каждый вызов
+            _TESS_API = PyTessBaseAPI(lang='rus', oem=OEM.LSTM_ONLY)
+        except RuntimeError as e:
+            log.warning("tesserocr не запустился (%s), используем pytesseract", e)
+
+
+def ocr(img: Image.Image, psm: int, config: str = '') -> str:
+    """ocr картинки через tesserocr, а если его нет - через pytesseract"""
+    if _TESS_API is not None:
+        _TESS_API.SetPageSegMode(psm)
+        _TESS_API.SetImage(img)
+        return _TESS_API.GetUTF8Text()
+    return pytesseract.image_to_string(img, lang='rus', config=config)
+
 
 def extract_text_from_pdf(pdf_path: str) -> str:
     """извлекает текст из pdf"""
     try:
         doc = fitz.open(pdf_path)
-        text = ""
+        parts = []
         
         for page_num, page in enumerate(doc):
             # обычный текст
@@ -27,34 +91,103 @@ def extract_text_from_pdf(pdf_path: str) -> str:
             
             # скан и гоняем через ocr
             if len(page_text.strip()) < 50:
-                print(f"         -> Страница {page_num+1}: используем OCR (мало текста)")
-                pix = page.get_pixmap(dpi=200)
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                page_text = pytesseract.image_to_string(img, lang='rus')
+                log.debug("%s: страница %d - используем OCR (мало текста)", pdf_path, page_num + 1)
+                pix = page.get_pixmap(dpi=200, colorspace=fitz.csGRAY)
+                img = Image.frombytes("L", [pix.width, pix.height], pix.samples)
+                page_text = ocr(img, psm=3)  # 3 - режим tesseract по умолчанию
             
-            text += page_text + "\n"
+            parts.append(page_text)
         
         doc.close()
-        return text.strip()
+        return "\n".join(parts).strip()
     except Exception as e:
-        print(f"[ERROR] {pdf_path}: {e}")
+        log.error("%s: %s", pdf_path, e)
         return ""
 
 
+def load_image_for_ocr(image_path: str) -> Image.Image:
+    """открывает картинку и готовит ее к ocr"""
+    img = Image.open(image_path)
+    # tesseract все равно бинаризует: серый канал и без гигантских фото с телефона
+    if img.mode != "L":
+        img = img.convert("L")
+    if max(img.size) > OCR_MAX_SIDE:
+        img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.BILINEAR)
+    return img
+
+
 def extract_text_from_image(image_path: str) -> str:
     """извлекает текст из картинки через tesseract"""
     try:
-        print(f"         -> Используем OCR для изображения")
-        img = Image.open(image_path)
-        text = pytesseract.image_to_string(img, lang='rus', config='--psm 6 --oem 1')
+        log.debug("%s: используем OCR для изображения", image_path)
+        img = load_image_for_ocr(image_path)
+        text = ocr(img, psm=6, config='--psm 6 --oem 1')
         return text.strip()
     except Exception as e:
-        print(f"[ERROR] {image_path}: {e}")
+        log.error("%s: %s", image_path, e)
         return ""
 
 
+def extract_texts_from_images(image_paths: List[Path]) -> List[str]:
+    """
+    ocr пачки картинок одним запуском tesseract: ему отдается список файлов,
+    страницы в выводе разделены своим маркером. модель языка грузится один раз на пачку.
+    если что-то пошло не так - откатываемся на картинку за картинкой.
+    """
+    if not image_paths:
+        return []
+    
+    log.debug("OCR пачкой: %d изображений", len(image_paths))
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prepared = []
+            for i, image_path in enumerate(image_paths):
+                prepared_path = os.path.join(tmp_dir, f"{i}.png")
+                load_image_for_ocr(str(image_path)).save(prepared_path)
+                prepared.append(prepared_path)
+            
+            list_file = os.path.join(tmp_dir, "images.txt")
+            with open(list_file, 'w', encoding='utf-8') as f:
+                f.write("\n".join(prepared))
+            
+            result = subprocess.run(
+                [pytesseract.pytesseract.tesseract_cmd, list_file, 'stdout',
+                 '-l', 'rus', '--psm', '6', '--oem', '1',
+                 '-c', f'page_separator={PAGE_SEPARATOR}'],
+                capture_output=True, check=True
+            )
+        
+        pages = result.stdout.decode('utf-8', errors='replace').split(PAGE_SEPARATOR)
+        # в зависимости от версии tesseract разделитель пишется только между страницами
+        # или еще и после последней - хвостовую пустую часть отбрасываем
+        if len(pages) == len(image_paths) + 1 and not pages[-1].strip():
+            pages.pop()
+        # любое другое число значит, что страницы не сопоставить с файлами
+        # (тексты съехали бы на чужие картинки и испортили разметку датасета)
+        if len(pages) != len(image_paths):
+            raise RuntimeError(f"tesseract вернул {len(pages)} страниц вместо {len(image_paths)}")
+        return [page.strip() for page in pages]
+    
+    except Exception as e:
+        log.warning("OCR пачкой не получился (%s), распознаем по одной", e)
+        return [extract_text_from_image(str(image_path)) for image_path in image_paths]
+
+
+def extract_one(file_path: Path) -> str:
+    """достает текст из одного файла, вызывается в процессах пула"""
+    file_ext = file_path.suffix.lower()
+    
+    # выбираем способ вытаскивать текст
+    if file_ext == '.pdf':
+        return extract_text_from_pdf(str(file_path))
+    elif file_ext in ['.jpg', '.jpeg', '.png']:
+        return extract_text_from_image(str(file_path))
+    return ""
+
+
 def main():
     """обходит все файлы и собирает датасет"""
+    setup_logging()
     print("="*80)
     print("ПОДГОТОВКА ДАТАСЕТА ДЛЯ BERT")
     print("="*80)
@@ -71,10 +204,22 @@ def main():
     print(f"\n[INFO] Ищем файлы в: {data_dir.absolute()}")
     print(f"[INFO] Папка существует: {data_dir.exists()}")
     
-    # собираем все поддерживаемые файлы
-    pdf_files = list(data_dir.glob("*.pdf"))
-    jpeg_files = list(data_dir.glob("*.jpg")) + list(data_dir.glob("*.jpeg"))
-    png_files = list(data_dir.glob("*.png"))
+    # собираем все поддерживаемые файлы за один обход папки
+    pdf_files = []
+    jpeg_files = []
+    png_files = []
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            # скрытые файлы glob('*.pdf') тоже не брал
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext == '.pdf':
+                pdf_files.append(Path(entry.path))
+            elif ext in ('.jpg', '.jpeg'):
+                jpeg_files.append(Path(entry.path))
+            elif ext == '.png':
+                png_files.append(Path(entry.path))
     
     all_files = pdf_files + jpeg_files + png_files
     
@@ -86,33 +231,49 @@ def main():
     
     dataset = []
     
-    for i, file_path in enumerate(all_files, 1):
-        file_ext = file_path.suffix.lower()
-        print(f"[{i}/{len(all_files)}] Обработка: {file_path.name}")
-        
-        # выбираем способ вытаскивать текст
-        if file_ext == '.pdf':
-            text = extract_text_from_pdf(str(file_path))
-        elif file_ext in ['.jpg', '.jpeg', '.png']:
-            text = extract_text_from_image(str(file_path))
+    # tesseract внутри сам плодит потоки openmp, при нескольких процессах
+    # это только мешает - каждому процессу по одному потоку
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    
+    # файлы независимы, ocr гоняем по всем ядрам; imap сохраняет порядок файлов
+    workers = os.cpu_count() or 1
+    with multiprocessing.Pool(processes=workers, initializer=init_worker) as pool:
+        image_files = jpeg_files + png_files
+        if PyTessBaseAPI is None and image_files:
+            # без tesserocr каждый вызов pytesseract - новый процесс tesseract,
+            # поэтому картинки раздаем пачками: один запуск tesseract на процесс пула
+            batch_size = -(-len(image_files) // workers)
+            batches = [image_files[i:i + batch_size] for i in range(0, len(image_files), batch_size)]
+            texts = itertools.chain(
+                pool.imap(extract_one, pdf_files),
+                itertools.chain.from_iterable(pool.imap(extract_texts_from_images, batches))
+            )
         else:
-            text = ""
+            texts = pool.imap(extract_one, all_files)
         
-        if text:
-            dataset.append({
-                "id": f"doc_{i}",
-                "filename": file_path.name,
-                "file_type": file_ext[1:],  # без точки
-                "text": text,
-                "length": len(text)
-            })
-            print(f"         -> Извлечено {len(text)} символов\n")
-        else:
-            print(f"         -> [SKIP] Пустой файл\n")
+        for i, (file_path, text) in enumerate(zip(all_files, texts), 1):
+            file_ext = file_path.suffix.lower()
+            log.info("[%d/%d] %s", i, len(all_files), file_path.name)
+            
+            if text:
+                dataset.append({
+                    "id": f"doc_{i}",
+                    "filename": file_path.name,
+                    "file_type": file_ext[1:],  # без точки
+                    "text": text,
+                    "length": len(text)
+                })
+                log.info("         -> извлечено %d символов", len(text))
+            else:
+                log.warning("%s: пустой файл, пропускаем", file_path.name)
     
     # сохраняем датасет
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(dataset, f, ensure_ascii=False, indent=2)
+    # формат тот же (indent 2, кириллица как есть), чтобы файл в git не менялся целиком
+    if orjson is not None:
+        output_file.write_bytes(orjson.dumps(dataset, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(dataset, f, ensure_ascii=False, indent=2)
     
     print("="*80)
     print(f"[OK] ДАТАСЕТ СОЗДАН!")
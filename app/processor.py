@@ -1,13 +1,19 @@
 import fitz 
 import pytesseract 
 from PIL import Image 
-import io
 import re 
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterator, List, Optional, Set, Tuple, Union
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from hashlib import blake2b
+import io
 import os
 import platform
+import subprocess
+import threading
 
 # небольшой хелпер: ищем tesseract под windows
 if platform.system() == 'Windows':
@@ -31,49 +37,237 @@ if platform.system() == 'Windows':
             print("   https://github.com/UB-Mannheim/tesseract/wiki")
 
 
-HYBRID_BERT_MODEL = None
+# страницы распознаются параллельно, поэтому сам tesseract пусть работает в один поток
+# (иначе openmp потоки каждой страницы дерутся за те же ядра); лимит передаем только
+# процессу tesseract - в окружении api он ограничил бы и потоки torch для bert
+OCR_OMP_THREAD_LIMIT = os.environ.get("OCR_OMP_THREAD_LIMIT", "1")
+
+# общий пул для ocr страниц: ограничивает число одновременных tesseract на весь процесс,
+# сколько бы pdf ни обрабатывалось параллельно
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", os.cpu_count() or 4))
+_OCR_EXECUTOR = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr-worker")
+
+# разрешение рендера для ocr: 150 dpi хватает для текста счетов и в ~1.8 раза меньше пикселей, чем 200
+OCR_DPI = int(os.environ.get("OCR_DPI", 150))
+
+# PDF_EARLY_EXIT=1: многостраничный pdf дочитываем только пока не найдены все основные поля
+# (по умолчанию выключено: гибридная модель берет максимальную сумму и пары ключ-значение
+# со всего текста, и пропущенные страницы могут изменить результат)
+PDF_EARLY_EXIT = os.environ.get("PDF_EARLY_EXIT", "0") == "1"
+# проверяем поля не после каждой страницы, а раз в столько страниц
+PDF_EARLY_EXIT_EVERY = max(1, int(os.environ.get("PDF_EARLY_EXIT_EVERY", 4)))
+
+# если текстовые блоки занимают хотя бы такую долю страницы, это цифровой pdf, а не скан
+OCR_TEXT_AREA_MIN = 0.05
 
+# кэш ocr по хэшу пикселей страницы: одинаковые страницы (шаблоны, повторные загрузки)
+# не гоняем через tesseract второй раз
+OCR_CACHE_SIZE = 512
+_OCR_CACHE: "OrderedDict[Tuple[int, int, bytes], str]" = OrderedDict()
+_OCR_CACHE_LOCK = threading.Lock()
+
+# tesserocr (если установлен) держит загруженный tesseract в памяти,
+# pytesseract же запускает новый процесс и грузит модель языка на каждую страницу
 try:
-    try:
-        from app.hybrid_bert_model import HybridBERTExtractor
-        print("[OK] Импортирован HybridBERTExtractor (API режим)")
-    except ImportError:
-        # fallback для запуска из jupyter
-        from hybrid_bert_model import HybridBERTExtractor
-        print("[OK] Импортирован HybridBERTExtractor (Jupyter режим)")
-    
-    # создаем одну общую инстанцию
-    print("[INFO] инициализация гибридной bert модели...")
-    HYBRID_BERT_MODEL = HybridBERTExtractor()
-    
-    model_info = HYBRID_BERT_MODEL.get_info()
-    print(f"[OK] Гибридная модель готова!")
-    print(f"   Тип: {model_info['model_type']}")
-    print(f"   Подход: {model_info['approach']}")
-    print(f"   ML компонент: {'ДА' if model_info['ml_enabled'] else 'НЕТ'}")
-    print(f"   BERT: {'ДА' if model_info['bert_loaded'] else 'НЕТ'}")
-    print(f"   Classifier: {'ДА' if model_info['classifier_trained'] else 'НЕТ'}")
+    from tesserocr import PyTessBaseAPI, PSM, OEM
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
+
+# api tesseract не потокобезопасен, а pdf парсятся в пуле потоков - по api на поток
+_TESS_LOCAL = threading.local()
+
+
+def _get_tess_api():
+    """ленивый PyTessBaseAPI текущего потока (rus, --psm 6 --oem 1)"""
+    api = getattr(_TESS_LOCAL, "api", None)
+    if api is None:
+        # TESSDATA_PREFIX позволяет подложить tessdata_fast (быстрые int-модели)
+        tessdata = os.environ.get("TESSDATA_PREFIX")
+        if tessdata:
+            api = PyTessBaseAPI(path=tessdata, lang='rus', psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+        else:
+            api = PyTessBaseAPI(lang='rus', psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+        _TESS_LOCAL.api = api
+    return api
+
+
+def ocr_image(img: Image.Image) -> str:
+    """распознает картинку: через tesserocr если можно, иначе через pytesseract"""
+    global TESSEROCR_AVAILABLE
+    if TESSEROCR_AVAILABLE:
+        try:
+            api = _get_tess_api()
+            api.SetImage(img)
+            return api.GetUTF8Text()
+        except RuntimeError as e:
+            # обычно не найдены tessdata для rus - дальше работаем через pytesseract
+            print(f"[WARNING] tesserocr недоступен ({e}), используется pytesseract")
+            TESSEROCR_AVAILABLE = False
     
-except Exception as e:
-    print(f"[WARNING] Не удалось загрузить Гибридную модель: {e}")
-    print(f"   Используется fallback regex подход")
+    return _tesseract_cli(img)
 
 
-def extract_text_from_pdf(pdf_bytes: bytes, verbose: bool = False) -> str:
+def _tesseract_cli(img: Image.Image) -> str:
     """
-    Извлекает текст из PDF, используя PyMuPDF.
-    Если PDF - скан или конвертированное изображение, автоматически использует Tesseract OCR.
-    
-    Args:
-        pdf_bytes: Байты PDF файла
-        verbose: Выводить подробные логи (по умолчанию False для скорости)
+    то же, что pytesseract.image_to_string(img, lang='rus', config='--psm 6 --oem 1'),
+    но со своим окружением для процесса tesseract (pytesseract отдает ему os.environ)
     """
-    full_text = ""
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    result = subprocess.run(
+        [pytesseract.pytesseract.tesseract_cmd, 'stdin', 'stdout',
+         '-l', 'rus', '--psm', '6', '--oem', '1'],
+        input=buf.getvalue(), capture_output=True, check=True,
+        env={**os.environ, "OMP_THREAD_LIMIT": OCR_OMP_THREAD_LIMIT}
+    )
+    return result.stdout.decode('utf-8', errors='replace')
+
+
+# " 1 234,56" -> "1234.56" за один проход
+_AMOUNT_FIX = str.maketrans({' ': None, ',': '.'})
+
+# паттерны process_with_regex компилируем один раз на модуль,
+# внутри каждого списка порядок = приоритет
+_INN_RE = re.compile(r"ИНН[:\s]*(\d{10,12})", re.IGNORECASE)
+
+# Ищем перед ИНН или в начале
+_VENDOR_RES = [
+    re.compile(r"(ООО\s+[\"«]?[^\"»\n]+[\"»]?)"),
+    re.compile(r"(АО\s+[\"«]?[^\"»\n]+[\"»]?)"),
+    re.compile(r"(ИП\s+[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+)"),
+    re.compile(r"([А-ЯЁ][А-ЯЁ\s]+(?:ООО|АО|ИП))"),
+]
+
+_INVOICE_RES = [
+    re.compile(r"Счет[:\s-]*(?:фактура)?[:\s#№]*(\d+)", re.IGNORECASE),
+    re.compile(r"Чек[:\s#№]*(\d+)", re.IGNORECASE),
+    re.compile(r"Документ[:\s#№]*(\d+)", re.IGNORECASE),
+    re.compile(r"№[:\s]*(\d+)", re.IGNORECASE),
+]
+
+_DATE_RES = [
+    re.compile(r"(\d{2}\.\d{2}\.\d{4})", re.IGNORECASE),  # 01.11.2025
+    re.compile(r"(\d{2}/\d{2}/\d{4})", re.IGNORECASE),    # 01/11/2025
+    re.compile(r"(\d{2}\.\d{2}\.\d{2})", re.IGNORECASE),  # 01.11.25
+    re.compile(r"(\d{1,2}\s+(?:января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)\s+\d{4})", re.IGNORECASE),  # 1 января 2025
+    re.compile(r"(\d{1,2}\s+(?:янв|фев|мар|апр|мая|июн|июл|авг|сен|окт|ноя|дек)\s+\d{4})", re.IGNORECASE),  # 1 янв 2025
+]
+
+_TOTAL_RES = [
+    re.compile(r"(?:Итого|ИТОГО|Всего|ВСЕГО|К оплате|Сумма)[:\s=]*([\d\s]+[.,]\d{2})", re.IGNORECASE),
+    re.compile(r"(?:итог|total)[:\s=]*([\d\s]+[.,]\d{2})", re.IGNORECASE),
+]
+
+_PHONE_RE = re.compile(r"[\+]?[7-8][\s-]?\(?(\d{3})\)?[\s-]?(\d{3})[\s-]?(\d{2})[\s-]?(\d{2})")
+_EMAIL_RE = re.compile(r"([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})")
+_ADDRESS_RE = re.compile(r"(?:Адрес|ADDRESS|адрес)[:\s]*([^\n]{10,100})", re.IGNORECASE)
+
+
+# модель грузится лениво при первом обращении (или на старте api через warmup),
+# импорт processor ничего тяжелого не делает
+_HYBRID_MODEL_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _load_hybrid_model():
+    try:
+        try:
+            from app.hybrid_bert_model import HybridBERTExtractor
+            print("[OK] Импортирован HybridBERTExtractor (API режим)")
+        except ImportError:
+            # fallback для запуска из jupyter
+            from hybrid_bert_model import HybridBERTExtractor
+            print("[OK] Импортирован HybridBERTExtractor (Jupyter режим)")
+        
+        # создаем одну общую инстанцию
+        print("[INFO] инициализация гибридной bert модели...")
+        model = HybridBERTExtractor()
+        
+        model_info = model.get_info()
+        print(f"[OK] Гибридная модель готова!")
+        print(f"   Тип: {model_info['model_type']}")
+        print(f"   Подход: {model_info['approach']}")
+        print(f"   ML компонент: {'ДА' if model_info['ml_enabled'] else 'НЕТ'}")
+        print(f"   BERT: {'ДА' if model_info['bert_loaded'] else 'НЕТ'}")
+        print(f"   Classifier: {'ДА' if model_info['classifier_trained'] else 'НЕТ'}")
+        return model
+        
+    except Exception as e:
+        print(f"[WARNING] Не удалось загрузить Гибридную модель: {e}")
+        print(f"   Используется fallback regex подход")
+        return None
+
+
+def get_hybrid_model():
+    """общая на процесс HybridBERTExtractor или None (тогда работает regex fallback)"""
+    # lru_cache сам по себе не мешает двум потокам грузить модель одновременно
+    with _HYBRID_MODEL_LOCK:
+        return _load_hybrid_model()
+
+
+def _open_pdf(pdf_source: Union[bytes, str, Path]):
+    """открывает pdf из байтов или с диска (путь читается mupdf напрямую, без копии в память)"""
+    if isinstance(pdf_source, (str, Path)):
+        return fitz.open(str(pdf_source), filetype="pdf")
+    return fitz.open(stream=pdf_source, filetype="pdf")
+
+
+def _text_area_ratio(page) -> float:
+    """доля площади страницы под текстовыми блоками (по get_text("blocks"), без рендера)"""
+    page_area = page.rect.width * page.rect.height
+    if page_area <= 0:
+        return 0.0
+    # блок: (x0, y0, x1, y1, text, block_no, block_type), type 0 - текст
+    text_area = sum(
+        (b[2] - b[0]) * (b[3] - b[1])
+        for b in page.get_text("blocks")
+        if b[6] == 0 and b[4].strip()
+    )
+    return text_area / page_area
+
+
+def _ocr_cache_get(key: Tuple[int, int, bytes]) -> Optional[str]:
+    with _OCR_CACHE_LOCK:
+        cached = _OCR_CACHE.get(key)
+        if cached is not None:
+            _OCR_CACHE.move_to_end(key)
+        return cached
+
+
+def _ocr_page(img: Image.Image, page_num: int, verbose: bool, cache_key: Tuple[int, int, bytes]) -> str:
+    """ocr одной страницы, выполняется в _OCR_EXECUTOR"""
     try:
-        # Открываем PDF файл
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        # только русский язык
+        text = ocr_image(img)
+        if verbose:
+            print(f"[INFO] OCR извлёк {len(text.strip())} символов (страница {page_num + 1})")
+    except Exception as e:
+        if verbose:
+            print(f"[ERROR] Ошибка Tesseract на странице {page_num}: {e}")
+        return ""
+    
+    # ошибки не кэшируем, только удачный результат
+    with _OCR_CACHE_LOCK:
+        _OCR_CACHE[cache_key] = text
+        if len(_OCR_CACHE) > OCR_CACHE_SIZE:
+            _OCR_CACHE.popitem(last=False)
+    return text
+
 
-        # Обрабатываем каждую страницу
+def iter_pdf_pages(pdf_source: Union[bytes, str, Path], verbose: bool = False) -> Iterator[Tuple[int, str]]:
+    """
+    Генератор (номер страницы, текст) в порядке страниц.
+    Страницы со сканами уходят в _OCR_EXECUTOR и распознаются параллельно
+    (не больше OCR_WORKERS впереди), страницы с текстом отдаются сразу -
+    если вызывающий перестал читать, оставшиеся страницы не рендерятся.
+    """
+    doc = _open_pdf(pdf_source)
+    # (номер страницы, текст или Future с ocr)
+    pending: "deque[Tuple[int, Union[str, Future]]]" = deque()
+    in_flight = 0
+    try:
+        # Обрабатываем каждую страницу (mupdf не потокобезопасен, рендер тут же)
         for page_num in range(len(doc)):
             page = doc.load_page(page_num)
             text = page.get_text()  # Пытаемся извлечь текст напрямую
@@ -84,30 +278,109 @@ def extract_text_from_pdf(pdf_bytes: bytes, verbose: bool = False) -> str:
                 len(text_stripped) < 100 or  # Увеличили порог с 50 до 100
                 text_stripped.replace('\n', '').replace(' ', '') == ''  # Только пробелы
             )
+            if needs_ocr and text_stripped:
+                # короткий, но настоящий текстовый слой (маленький чек) - ocr не нужен
+                needs_ocr = _text_area_ratio(page) < OCR_TEXT_AREA_MIN
             
             if needs_ocr:
                 if verbose:
                     print(f"[INFO] Страница {page_num + 1}: используется OCR (текста: {len(text_stripped)} символов)")
                 
-                pix = page.get_pixmap(dpi=200)
-                img_bytes = pix.tobytes("png")
-                img = Image.open(io.BytesIO(img_bytes))
-                try:
-                    # только русский язык
-                    text = pytesseract.image_to_string(img, lang='rus', config='--psm 6 --oem 1')
+                # серый канал: tesseract все равно бинаризует, а байт втрое меньше
+                pix = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+                samples = pix.samples
+                cache_key = (pix.width, pix.height, blake2b(samples, digest_size=16).digest())
+                cached = _ocr_cache_get(cache_key)
+                if cached is not None:
                     if verbose:
-                        print(f"[INFO] OCR извлёк {len(text.strip())} символов")
-                except Exception as e:
-                    if verbose:
-                        print(f"[ERROR] Ошибка Tesseract на странице {page_num}: {e}")
-                    text = ""
+                        print(f"[INFO] Страница {page_num + 1}: OCR взят из кэша")
+                    pending.append((page_num, cached))
+                else:
+                    # сырые пиксели сразу в PIL, без кодирования в png и обратно
+                    img = Image.frombytes("L", (pix.width, pix.height), samples)
+                    pending.append((page_num, _OCR_EXECUTOR.submit(_ocr_page, img, page_num, verbose, cache_key)))
+                    in_flight += 1
             else:
                 if verbose:
                     print(f"[INFO] Страница {page_num + 1}: текст извлечён напрямую ({len(text_stripped)} символов)")
+                pending.append((page_num, text))
+            
+            # отдаем готовое по порядку; если ocr уже далеко впереди - ждем голову очереди,
+            # чтобы не держать в памяти картинки всех страниц
+            while pending:
+                head_num, head = pending[0]
+                if isinstance(head, Future):
+                    if not head.done() and in_flight < OCR_WORKERS:
+                        break
+                    head = head.result()
+                    in_flight -= 1
+                pending.popleft()
+                yield head_num, head
+        
+        while pending:
+            head_num, head = pending.popleft()
+            if isinstance(head, Future):
+                head = head.result()
+            yield head_num, head
+    
+    finally:
+        # генератор могли бросить на середине - ocr, который еще не начат, отменяем
+        for _, head in pending:
+            if isinstance(head, Future):
+                head.cancel()
+        doc.close()
 
-            full_text += text + "\n"
 
-        doc.close()
+def _missing_core_fields(text: str, missing: Optional[Set[str]] = None) -> Set[str]:
+    """
+    какие из основных полей (missing, по умолчанию все) не найдены в text;
+    проверяет тот же извлекатель, который потом даст результат в extract_invoice_data
+    """
+    hybrid_model = get_hybrid_model()
+    if hybrid_model is not None:
+        data = hybrid_model.extract_with_regex(text)
+        found = {field for field in ("inn", "vendor", "date", "total") if field in data}
+        required = {"inn", "vendor", "date", "total"}
+    else:
+        data = process_with_regex(text)
+        found = {field for field in ("inn", "vendor", "invoice_number", "date") if data[field] != "UNRECOGNIZED"}
+        if isinstance(data["total"], float):
+            found.add("total")
+        required = {"inn", "vendor", "invoice_number", "date", "total"}
+    return (required if missing is None else missing) - found
+
+
+def extract_text_from_pdf(pdf_source: Union[bytes, str, Path], verbose: bool = False,
+                          early_exit: bool = False) -> str:
+    """
+    Извлекает текст из PDF, используя PyMuPDF.
+    Если PDF - скан или конвертированное изображение, автоматически использует Tesseract OCR.
+    Страницы со сканами распознаются параллельно в _OCR_EXECUTOR, текст собирается в порядке страниц.
+    
+    Args:
+        pdf_source: Байты PDF файла или путь к нему
+        verbose: Выводить подробные логи (по умолчанию False для скорости)
+        early_exit: Остановиться, как только в прочитанных страницах найдены все основные поля
+                    (проверка раз в PDF_EARLY_EXIT_EVERY страниц)
+    """
+    try:
+        page_texts: List[str] = []
+        missing = None
+        checked = 0  # сколько страниц уже проверено на основные поля
+        for page_num, text in iter_pdf_pages(pdf_source, verbose=verbose):
+            page_texts.append(text)
+            if early_exit and len(page_texts) - checked >= PDF_EARLY_EXIT_EVERY:
+                # проверяем только новые страницы и копим найденное: без повторной
+                # склейки и разбора всего уже прочитанного текста
+                missing = _missing_core_fields("".join(t + "\n" for t in page_texts[checked:]), missing)
+                checked = len(page_texts)
+                if not missing:
+                    if verbose:
+                        print(f"[INFO] Все основные поля найдены к странице {page_num + 1}, остальные страницы пропущены")
+                    break
+        
+        # одна склейка вместо += на каждую страницу
+        full_text = "".join(text + "\n" for text in page_texts)
         
         if len(full_text.strip()) == 0 and verbose:
             print("⚠️ Не удалось извлечь текст из PDF")
@@ -135,24 +408,16 @@ def process_with_regex(raw_text: str) -> Dict[str, Any]:
     UNRECOGNIZED = "UNRECOGNIZED"  #для нераспознанных полей
 
     # 1. Извлечение ИНН (10 или 12 цифр)
-    inn_match = re.search(r"ИНН[:\s]*(\d{10,12})", raw_text, re.IGNORECASE)
+    inn_match = _INN_RE.search(raw_text)
     if inn_match:
         data["inn"] = inn_match.group(1)
     else:
         data["inn"] = UNRECOGNIZED
 
     # 2. Извлечение названия организации (vendor)
-    # Ищем перед ИНН или в начале
-    vendor_patterns = [
-        r"(ООО\s+[\"«]?[^\"»\n]+[\"»]?)",
-        r"(АО\s+[\"«]?[^\"»\n]+[\"»]?)",
-        r"(ИП\s+[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+)",
-        r"([А-ЯЁ][А-ЯЁ\s]+(?:ООО|АО|ИП))",
-    ]
-    
     vendor_found = False
-    for pattern in vendor_patterns:
-        vendor_match = re.search(pattern, raw_text)
+    for vendor_re in _VENDOR_RES:
+        vendor_match = vendor_re.search(raw_text)
         if vendor_match:
             data["vendor"] = vendor_match.group(1).strip()
             vendor_found = True
@@ -162,16 +427,9 @@ def process_with_regex(raw_text: str) -> Dict[str, Any]:
         data["vendor"] = UNRECOGNIZED
 
     # 3. Извлечение номера счета/чека
-    invoice_patterns = [
-        r"Счет[:\s-]*(?:фактура)?[:\s#№]*(\d+)",
-        r"Чек[:\s#№]*(\d+)",
-        r"Документ[:\s#№]*(\d+)",
-        r"№[:\s]*(\d+)",
-    ]
-    
     invoice_found = False
-    for pattern in invoice_patterns:
-        invoice_match = re.search(pattern, raw_text, re.IGNORECASE)
+    for invoice_re in _INVOICE_RES:
+        invoice_match = invoice_re.search(raw_text)
         if invoice_match:
             data["invoice_number"] = invoice_match.group(1)
             invoice_found = True
@@ -181,17 +439,9 @@ def process_with_regex(raw_text: str) -> Dict[str, Any]:
         data["invoice_number"] = UNRECOGNIZED
 
     # 4. Извлечение даты (различные форматы)
-    date_patterns = [
-        r"(\d{2}\.\d{2}\.\d{4})",  # 01.11.2025
-        r"(\d{2}/\d{2}/\d{4})",    # 01/11/2025
-        r"(\d{2}\.\d{2}\.\d{2})",  # 01.11.25
-        r"(\d{1,2}\s+(?:января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)\s+\d{4})",  # 1 января 2025
-        r"(\d{1,2}\s+(?:янв|фев|мар|апр|мая|июн|июл|авг|сен|окт|ноя|дек)\s+\d{4})",  # 1 янв 2025
-    ]
-    
     date_found = False
-    for pattern in date_patterns:
-        date_match = re.search(pattern, raw_text, re.IGNORECASE)
+    for date_re in _DATE_RES:
+        date_match = date_re.search(raw_text)
         if date_match:
             data["date"] = date_match.group(1)
             date_found = True
@@ -201,16 +451,11 @@ def process_with_regex(raw_text: str) -> Dict[str, Any]:
         data["date"] = UNRECOGNIZED
 
     # 5. Извлечение итоговой суммы
-    total_patterns = [
-        r"(?:Итого|ИТОГО|Всего|ВСЕГО|К оплате|Сумма)[:\s=]*([\d\s]+[.,]\d{2})",
-        r"(?:итог|total)[:\s=]*([\d\s]+[.,]\d{2})",
-    ]
-    
     total_found = False
-    for pattern in total_patterns:
-        total_match = re.search(pattern, raw_text, re.IGNORECASE)
+    for total_re in _TOTAL_RES:
+        total_match = total_re.search(raw_text)
         if total_match:
-            amount_str = total_match.group(1).replace(" ", "").replace(",", ".")
+            amount_str = total_match.group(1).translate(_AMOUNT_FIX)
             try:
                 data["total"] = float(amount_str)
             except ValueError:
@@ -223,26 +468,27 @@ def process_with_regex(raw_text: str) -> Dict[str, Any]:
 
     # 6. Извлечение дополнительной информации
     # Телефон
-    phone_match = re.search(r"[\+]?[7-8][\s-]?\(?(\d{3})\)?[\s-]?(\d{3})[\s-]?(\d{2})[\s-]?(\d{2})", raw_text)
+    phone_match = _PHONE_RE.search(raw_text)
     if phone_match:
         data["phone"] = f"+7{phone_match.group(1)}{phone_match.group(2)}{phone_match.group(3)}{phone_match.group(4)}"
 
-    # Email
-    email_match = re.search(r"([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})", raw_text)
+    # Email (без '@' регулярку не запускаем)
+    email_match = _EMAIL_RE.search(raw_text) if '@' in raw_text else None
     if email_match:
         data["email"] = email_match.group(1)
 
     # Адрес (базовая попытка)
-    address_match = re.search(r"(?:Адрес|ADDRESS|адрес)[:\s]*([^\n]{10,100})", raw_text, re.IGNORECASE)
+    address_match = _ADDRESS_RE.search(raw_text)
     if address_match:
         data["address"] = address_match.group(1).strip()
 
     return data
 
 
-def extract_invoice_data(pdf_bytes: bytes, verbose: bool = False) -> Dict[str, Any]:
+def extract_invoice_data(pdf_source: Union[bytes, str, Path], verbose: bool = False) -> Dict[str, Any]:
     """
     Главная функция-пайплайн для извлечения данных из PDF счета.
+    pdf_source - байты PDF или путь к файлу на диске.
     
     Этапы обработки:
     1. Извлекает текст из PDF (с поддержкой OCR для сканов)
@@ -251,7 +497,7 @@ def extract_invoice_data(pdf_bytes: bytes, verbose: bool = False) -> Dict[str, A
     """
     try:
         # Шаг 1: Извлечение текста из PDF
-        text = extract_text_from_pdf(pdf_bytes, verbose=verbose)
+        text = extract_text_from_pdf(pdf_source, verbose=verbose, early_exit=PDF_EARLY_EXIT)
         
         if not text or len(text.strip()) < 10:
             return {
@@ -263,11 +509,12 @@ def extract_invoice_data(pdf_bytes: bytes, verbose: bool = False) -> Dict[str, A
             print(f"[INFO] Извлечено {len(text)} символов текста")
         
         # Шаг 2: Обработка текста
-        if HYBRID_BERT_MODEL is not None:
+        hybrid_model = get_hybrid_model()
+        if hybrid_model is not None:
             # Используем Гибридную модель (ML + Regex)
             if verbose:
                 print("[INFO] Используется Гибридная модель (ML + Regex)")
-            extracted_data = HYBRID_BERT_MODEL.predict(text)
+            extracted_data = hybrid_model.predict(text)
         else:
             # Fallback на regex подход
             if verbose:
@@ -4,53 +4,55 @@ Few-Shot Learning для извлечения данных из финансов
 """
 
 import json
+import os
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, TensorDataset
 from transformers import AutoTokenizer, AutoModel
 from pathlib import Path
 import re
 from typing import Dict, List, Tuple
 import random
+from contextlib import nullcontext
+
+# все тексты токенизируются одним вызовом (ReceiptDataset), пусть rust tokenizer
+# работает во всех потоках; DataLoader воркеров (fork) тут нет, так что это безопасно
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
+
+# поля классификатора, порядок = порядок выходов головы
+FIELDS = ['has_inn', 'has_total', 'has_date', 'has_vendor']
 
 
 class ReceiptDataset(Dataset):
     """Датасет для обучения на чеках"""
     
     def __init__(self, texts: List[str], labels: List[Dict], tokenizer, max_length=512):
-        self.texts = texts
-        self.labels = labels
-        self.tokenizer = tokenizer
-        self.max_length = max_length
-    
-    def __len__(self):
-        return len(self.texts)
-    
-    def __getitem__(self, idx):
-        text = self.texts[idx]
-        label_dict = self.labels[idx]
-        
-        # токенизация текста
-        encoding = self.tokenizer(
-            text,
-            max_length=self.max_length,
+        # токенизируем все тексты один раз, а не на каждый __getitem__ каждой эпохи
+        encoding = tokenizer(
+            texts,
+            max_length=max_length,
             padding='max_length',
             truncation=True,
             return_tensors='pt'
         )
+        self.input_ids = encoding['input_ids']
+        self.attention_mask = encoding['attention_mask']
         
-        # превращаем метки в тензор
-        label_tensor = torch.tensor([
-            label_dict['has_inn'],
-            label_dict['has_total'],
-            label_dict['has_date'],
-            label_dict['has_vendor']
+        # превращаем метки в тензор [N, 4]
+        self.labels = torch.tensor([
+            [label_dict[field] for field in FIELDS]
+            for label_dict in labels
         ], dtype=torch.float32)
-        
+    
+    def __len__(self):
+        return len(self.input_ids)
+    
+    def __getitem__(self, idx):
         return {
-            'input_ids': encoding['input_ids'].squeeze(0),
-            'attention_mask': encoding['attention_mask'].squeeze(0),
-            'labels': label_tensor
+            'input_ids': self.input_ids[idx],
+            'attention_mask': self.attention_mask[idx],
+            'labels': self.labels[idx]
         }
 
 
@@ -64,41 +66,75 @@ class ReceiptClassifier(nn.Module):
         super().__init__()
         
         # загружаем bert и замораживаем веса
-        self.bert = AutoModel.from_pretrained(bert_model_name)
+        # pooler (dense+tanh над [CLS]) не нужен: голова учится прямо на скрытом состоянии [CLS]
+        self.bert = AutoModel.from_pretrained(bert_model_name, add_pooling_layer=False)
         for param in self.bert.parameters():
             param.requires_grad = False  # bert не обучаем
+        # замороженный bert всегда в eval: его dropout не должен включаться вместе с головами
+        self.bert.eval()
         
         hidden_size = self.bert.config.hidden_size
         
-        # отдельный выход для каждого поля
-        self.has_inn = nn.Linear(hidden_size, 1)     # есть инн
-        self.has_total = nn.Linear(hidden_size, 1)   # есть сумма
-        self.has_date = nn.Linear(hidden_size, 1)    # есть дата
-        self.has_vendor = nn.Linear(hidden_size, 1)  # есть поставщик
+        # одна голова на все поля: выход [batch, 4] в порядке FIELDS
+        # (inn, total, date, vendor), один matmul вместо четырех
+        self.head = nn.Linear(hidden_size, len(FIELDS))
         
         # легкий dropout
         self.dropout = nn.Dropout(0.3)
     
+    def train(self, mode: bool = True):
+        """model.train() переключает только головы, bert остается в eval"""
+        super().train(mode)
+        self.bert.eval()
+        return self
+    
     def forward(self, input_ids, attention_mask):
-        # берем pooled выход bert
+        # берем скрытое состояние [CLS] токена
         outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
-        pooled_output = outputs.pooler_output  # [batch, hidden_size]
-        
+        pooled_output = outputs.last_hidden_state[:, 0]  # [batch, hidden_size]
+        return self.heads(pooled_output)
+    
+    def heads(self, pooled_output):
+        """только обучаемая часть: dropout + линейная голова, возвращает логиты [batch, 4]"""
         # немного шума
         x = self.dropout(pooled_output)
-        
-        # применяем линейные головы
-        has_inn = torch.sigmoid(self.has_inn(x))
-        has_total = torch.sigmoid(self.has_total(x))
-        has_date = torch.sigmoid(self.has_date(x))
-        has_vendor = torch.sigmoid(self.has_vendor(x))
-        
-        return {
-            'has_inn': has_inn,
-            'has_total': has_total,
-            'has_date': has_date,
-            'has_vendor': has_vendor
-        }
+        # sigmoid не применяем: он внутри BCEWithLogitsLoss (и так численно стабильнее)
+        return self.head(x)
+
+
+def bert_autocast(device):
+    """
+    mixed precision для forward замороженного bert: bf16/fp16 на gpu (через bert
+    градиенты не идут, так что scaler не нужен), на cpu оставляем fp32
+    """
+    if device.type != 'cuda':
+        return nullcontext()
+    dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return torch.autocast(device_type='cuda', dtype=dtype)
+
+
+def precompute_features(bert, dataset: ReceiptDataset, device, batch_size: int = 16) -> torch.Tensor:
+    """
+    bert заморожен, поэтому его выход для каждого текста не меняется между эпохами:
+    прогоняем bert один раз и дальше учим головы на готовых [CLS] векторах [N, hidden]
+    """
+    bert.eval()
+    features = []
+    # no_grad, а не inference_mode: из inference-тензоров потом нельзя учить головы
+    # (autograd не может сохранить их для backward)
+    with torch.no_grad(), bert_autocast(device):
+        loader = DataLoader(dataset, batch_size=batch_size, pin_memory=device.type == 'cuda')
+        for batch in loader:
+            outputs = bert(
+                input_ids=batch['input_ids'].to(device, non_blocking=True),
+                attention_mask=batch['attention_mask'].to(device, non_blocking=True)
+            )
+            # головы учим в fp32, что бы ни выдал autocast
+            features.append(outputs.last_hidden_state[:, 0].float().cpu())
+    return torch.cat(features)
+
+
+_WS_RE = re.compile(r'\s+')
 
 
 def augment_text(text: str) -> List[str]:
@@ -106,31 +142,32 @@ def augment_text(text: str) -> List[str]:
     Data Augmentation: создаем вариации текста
     24 документа × 5 вариаций = 120 примеров
     """
-    variations = [text]  # Оригинал
-    
-    # 1. Убираем лишние пробелы
-    var1 = re.sub(r'\s+', ' ', text)
-    variations.append(var1)
-    
-    # 2. Добавляем/убираем переносы строк
-    var2 = text.replace('\n\n', '\n')
-    variations.append(var2)
+    variations = [
+        text,  # Оригинал
+        _WS_RE.sub(' ', text),  # 1. Убираем лишние пробелы
+        text.replace('\n\n', '\n'),  # 2. Добавляем/убираем переносы строк
+    ]
     
     # 3. Изменяем регистр некоторых слов (имитация OCR ошибок)
     words = text.split()
     if len(words) > 10:
-        var3_words = words.copy()
-        for i in random.sample(range(len(var3_words)), min(3, len(var3_words))):
-            if var3_words[i].isupper():
-                var3_words[i] = var3_words[i].lower()
-        var3 = ' '.join(var3_words)
-        variations.append(var3)
+        # words больше нигде не нужен, меняем его на месте без копии
+        for i in random.sample(range(len(words)), 3):
+            if words[i].isupper():
+                words[i] = words[i].lower()
+        variations.append(' '.join(words))
     
     # 4. Добавляем небольшой "шум" (лишние пробелы)
-    var4 = text.replace(' ', '  ')
-    variations.append(var4)
+    variations.append(text.replace(' ', '  '))
     
-    return variations[:5]  # Максимум 5 вариаций
+    return variations  # не больше 5 вариаций
+
+
+# паттерны для ground truth, компилируем один раз (вызывается на каждый документ)
+_GT_INN_RE = re.compile(r'\bИНН[:\s]*\d{10,12}', re.IGNORECASE)
+_GT_TOTAL_RE = re.compile(r'(?:ИТОГО|СУММА|TOTAL)', re.IGNORECASE)
+_GT_DATE_RE = re.compile(r'\d{2}[.]\d{2}[.]\d{2,4}')
+_GT_VENDOR_RE = re.compile(r'(?:ООО|ИП|ПАО|АО)')
 
 
 def extract_ground_truth(text: str) -> Dict[str, float]:
@@ -140,16 +177,16 @@ def extract_ground_truth(text: str) -> Dict[str, float]:
     labels = {}
     
     # ИНН
-    labels['has_inn'] = 1.0 if re.search(r'\bИНН[:\s]*\d{10,12}', text, re.IGNORECASE) else 0.0
+    labels['has_inn'] = 1.0 if _GT_INN_RE.search(text) else 0.0
     
     # Сумма/Итого
-    labels['has_total'] = 1.0 if re.search(r'(?:ИТОГО|СУММА|TOTAL)', text, re.IGNORECASE) else 0.0
+    labels['has_total'] = 1.0 if _GT_TOTAL_RE.search(text) else 0.0
     
     # Дата
-    labels['has_date'] = 1.0 if re.search(r'\d{2}[.]\d{2}[.]\d{2,4}', text) else 0.0
+    labels['has_date'] = 1.0 if _GT_DATE_RE.search(text) else 0.0
     
     # Поставщик
-    labels['has_vendor'] = 1.0 if re.search(r'(?:ООО|ИП|ПАО|АО)', text) else 0.0
+    labels['has_vendor'] = 1.0 if _GT_VENDOR_RE.search(text) else 0.0
     
     return labels
 
@@ -178,8 +215,9 @@ def prepare_training_data():
     # Augmentation + извлечение labels
     all_texts = []
     all_labels = []
+    all_doc_ids = []  # из какого документа вариация (для честного train/val split)
     
-    for doc in dataset:
+    for doc_idx, doc in enumerate(dataset):
         text = doc['text']
         
         # Ground truth labels
@@ -191,26 +229,47 @@ def prepare_training_data():
         for var in variations:
             all_texts.append(var)
             all_labels.append(labels)
+            all_doc_ids.append(doc_idx)
     
     print(f"[OK] После augmentation: {len(all_texts)} примеров")
     print(f"    Увеличение: {len(dataset)} -> {len(all_texts)} (x{len(all_texts)/len(dataset):.1f})")
     
-    return all_texts, all_labels
+    return all_texts, all_labels, all_doc_ids
+
+
+def split_by_document(doc_ids: List[int], val_fraction: float = 0.2, seed: int = 42) -> Tuple[List[int], List[int]]:
+    """
+    train/val split по документам: все вариации одного документа попадают
+    целиком либо в train, либо в val (иначе val видит те же чеки, что и train)
+    """
+    docs = sorted(set(doc_ids))
+    if len(docs) < 2:
+        raise ValueError(f"для train/val split по документам нужно хотя бы 2 документа, а есть {len(docs)}")
+    random.Random(seed).shuffle(docs)
+    # хотя бы один документ в val и хотя бы один в train
+    n_val = min(max(1, round(len(docs) * val_fraction)), len(docs) - 1)
+    val_docs = set(docs[:n_val])
+    
+    train_idx = [i for i, doc_id in enumerate(doc_ids) if doc_id not in val_docs]
+    val_idx = [i for i, doc_id in enumerate(doc_ids) if doc_id in val_docs]
+    return train_idx, val_idx
 
 
-def train_model(epochs=20):
+def train_model(epochs=20, batch_size=16):
     """Обучение модели"""
     print("\n" + "="*80)
     print("ОБУЧЕНИЕ FEW-SHOT МОДЕЛИ")
     print("="*80)
     
     # Подготовка данных
-    texts, labels = prepare_training_data()
+    texts, labels, doc_ids = prepare_training_data()
     
-    # Разделение на train/val (80/20)
-    split_idx = int(len(texts) * 0.8)
-    train_texts, val_texts = texts[:split_idx], texts[split_idx:]
-    train_labels, val_labels = labels[:split_idx], labels[split_idx:]
+    # Разделение на train/val (80/20 по документам, с фиксированным seed)
+    train_idx, val_idx = split_by_document(doc_ids)
+    train_texts = [texts[i] for i in train_idx]
+    val_texts = [texts[i] for i in val_idx]
+    train_labels = [labels[i] for i in train_idx]
+    val_labels = [labels[i] for i in val_idx]
     
     print(f"\n[OK] Train: {len(train_texts)} | Val: {len(val_texts)}")
     
@@ -218,15 +277,12 @@ def train_model(epochs=20):
     model_name = "DeepPavlov/rubert-base-cased"
     print(f"\n[INFO] Загрузка {model_name}...")
     
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
     
     # Создаем datasets
     train_dataset = ReceiptDataset(train_texts, train_labels, tokenizer)
     val_dataset = ReceiptDataset(val_texts, val_labels, tokenizer)
     
-    train_loader = DataLoader(train_dataset, batch_size=4, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=4)
-    
     # Модель
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f"[OK] Устройство: {device}")
@@ -234,13 +290,26 @@ def train_model(epochs=20):
     model = ReceiptClassifier(model_name, {})
     model.to(device)
     
-    # Optimizer (только для trainable параметров!)
-    trainable_params = [p for p in model.parameters() if p.requires_grad]
-    optimizer = torch.optim.Adam(trainable_params, lr=0.001)
-    criterion = nn.BCELoss()
+    # bert прогоняем по данным один раз, эпохи идут только по головам
+    print(f"[INFO] Считаем BERT признаки ({len(train_dataset) + len(val_dataset)} текстов)...")
+    train_features = precompute_features(model.bert, train_dataset, device, batch_size=batch_size)
+    val_features = precompute_features(model.bert, val_dataset, device, batch_size=batch_size)
+    
+    # данные уже тензоры в памяти: воркеры DataLoader тут только добавили бы накладные расходы,
+    # а pinned memory + non_blocking дают асинхронное копирование на gpu
+    pin_memory = device.type == 'cuda'
+    train_loader = DataLoader(TensorDataset(train_features, train_dataset.labels), batch_size=batch_size, shuffle=True,
+                              pin_memory=pin_memory)
+    val_loader = DataLoader(TensorDataset(val_features, val_dataset.labels), batch_size=batch_size,
+                            pin_memory=pin_memory)
     
-    print(f"[OK] Trainable параметров: {sum(p.numel() for p in trainable_params):,}")
-    print(f"[OK] Frozen параметров: {sum(p.numel() for p in model.parameters() if not p.requires_grad):,}")
+    # Optimizer: обучаемая часть это только голова, весь bert не перебираем
+    # (fused AdamW есть только для cuda)
+    optimizer = torch.optim.AdamW(model.head.parameters(), lr=0.001, fused=device.type == 'cuda')
+    criterion = nn.BCEWithLogitsLoss()
+    
+    print(f"[OK] Trainable параметров: {sum(p.numel() for p in model.head.parameters()):,}")
+    print(f"[OK] Frozen параметров: {sum(p.numel() for p in model.bert.parameters()):,}")
     
     # Training loop
     history = {'train_loss': [], 'val_loss': [], 'val_acc': []}
@@ -254,22 +323,17 @@ def train_model(epochs=20):
         model.train()
         train_loss = 0
         
-        for batch in train_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            labels_batch = batch['labels'].to(device)  # [batch_size, 4]
+        for features_batch, labels_batch in train_loader:
+            features_batch = features_batch.to(device, non_blocking=True)  # [batch_size, hidden]
+            labels_batch = labels_batch.to(device, non_blocking=True)  # [batch_size, 4]
             
             optimizer.zero_grad()
             
-            # Forward
-            outputs = model(input_ids, attention_mask)
+            # Forward (только головы, bert уже посчитан)
+            logits = model.heads(features_batch)  # [batch_size, 4]
             
-            # Loss для каждого поля
-            loss = 0
-            fields = ['has_inn', 'has_total', 'has_date', 'has_vendor']
-            for idx, field in enumerate(fields):
-                targets = labels_batch[:, idx].unsqueeze(1)  # [batch_size, 1]
-                loss += criterion(outputs[field], targets)
+            # Loss: как и раньше сумма loss по 4 полям (среднее * число полей)
+            loss = criterion(logits, labels_batch) * len(FIELDS)
             
             # Backward
             loss.backward()
@@ -281,34 +345,30 @@ def train_model(epochs=20):
         
         # VALIDATION
         model.eval()
-        val_loss = 0
-        correct = 0
         total = 0
         
-        with torch.no_grad():
-            for batch in val_loader:
-                input_ids = batch['input_ids'].to(device)
-                attention_mask = batch['attention_mask'].to(device)
-                labels_batch = batch['labels'].to(device)  # [batch_size, 4]
+        with torch.inference_mode():
+            # копим на устройстве, синхронизация с gpu один раз за эпоху, а не на каждый батч
+            val_loss = torch.zeros((), device=device)
+            correct = torch.zeros((), device=device)
+            for features_batch, labels_batch in val_loader:
+                features_batch = features_batch.to(device, non_blocking=True)
+                labels_batch = labels_batch.to(device, non_blocking=True)  # [batch_size, 4]
                 
-                outputs = model(input_ids, attention_mask)
+                logits = model.heads(features_batch)
                 
                 # Loss
-                loss = 0
-                fields = ['has_inn', 'has_total', 'has_date', 'has_vendor']
-                for idx, field in enumerate(fields):
-                    targets = labels_batch[:, idx].unsqueeze(1)  # [batch_size, 1]
-                    loss += criterion(outputs[field], targets)
-                    
-                    # Accuracy
-                    predictions = (outputs[field] > 0.5).float()
-                    correct += (predictions == targets).sum().item()
-                    total += targets.numel()
+                loss = criterion(logits, labels_batch) * len(FIELDS)
+                
+                # Accuracy (logit > 0 <=> sigmoid > 0.5)
+                predictions = (logits > 0).float()
+                correct += (predictions == labels_batch).sum()
+                total += labels_batch.numel()
                 
-                val_loss += loss.item()
+                val_loss += loss
         
-        val_loss /= len(val_loader)
-        val_acc = correct / total
+        val_loss = val_loss.item() / len(val_loader)
+        val_acc = correct.item() / total
         
         # Сохраняем историю
         history['train_loss'].append(train_loss)
@@ -331,8 +391,12 @@ def train_model(epochs=20):
         save_path = Path("app/models/few_shot_classifier")
     save_path.mkdir(parents=True, exist_ok=True)
     
+    # bert заморожен и совпадает с весами из hub, поэтому сохраняем только голову
+    # (несколько кб вместо ~680 мб) и имя bert, на котором она обучена
     torch.save({
-        'model_state_dict': model.state_dict(),
+        'head_state_dict': model.head.state_dict(),
+        'bert_model_name': model_name,
+        'pooling': 'cls',  # голова обучена на [CLS], а не на pooler_output
         'history': history
     }, save_path / "model.pt")
     
@@ -5,6 +5,10 @@ echo "=== checking ml model (model.pt) ==="
 python download_model.py || echo "ml model was not downloaded, api будет работать только на regex"
 
 echo "=== starting api ==="
-uvicorn app.main:app --host 0.0.0.0 --port 8000
+# uvloop + httptools (ставятся вместе с uvicorn[standard]) - явно, без молчаливого отката на asyncio/h11
+# каждый воркер грузит свою копию BERT, поэтому по умолчанию один
+exec uvicorn app.main:app --host 0.0.0.0 --port 8000 \
+    --loop uvloop --http httptools \
+    --workers "${API_WORKERS:-1}"
 
 
@@ -4,9 +4,10 @@
 """
 
 import os
+import re
 import sys
 from pathlib import Path
-import urllib.request
+import requests
 from tqdm import tqdm
 
 # Конфигурация
@@ -21,13 +22,56 @@ GOOGLE_DRIVE_FILE_ID = "1JSfkUnS4Y0JlKzh7thPRoEMCIvruP7GE"
 # вариант 2: прямая ссылка (если когда‑нибудь поменяешь хостинг)
 DIRECT_URL = None  # например: "https://example.com/model.pt"
 
+# читаем ответ крупными кусками: меньше системных вызовов и обновлений progress bar
+CHUNK_SIZE = 1 << 20  # 1 MB
+TIMEOUT = 60  # секунд на соединение/чтение куска
 
-class DownloadProgressBar(tqdm):
-    """Progress bar для urllib"""
-    def update_to(self, b=1, bsize=1, tsize=None):
-        if tsize is not None:
-            self.total = tsize
-        self.update(b * bsize - self.n)
+
+def _save_stream(response: requests.Response, destination: Path):
+    """пишет потоковый ответ в файл через .part, чтобы битая загрузка не выглядела как готовая модель"""
+    response.raise_for_status()
+    # вместо файла пришла html страница (ошибка/подтверждение google drive)
+    if response.headers.get('Content-Type', '').startswith('text/html'):
+        raise RuntimeError("сервер вернул HTML страницу вместо файла модели")
+    
+    total = int(response.headers.get('Content-Length', 0)) or None
+    tmp_path = destination.with_name(destination.name + '.part')
+    try:
+        # перерисовываем не чаще раза в полсекунды: в docker tty вывод бара заметно тормозит
+        with open(tmp_path, 'wb') as f, tqdm(total=total, unit='B', unit_scale=True, desc=destination.name,
+                                             mininterval=0.5, ascii=True) as t:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                t.update(len(chunk))
+        os.replace(tmp_path, destination)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def _google_drive_confirm_params(response: requests.Response, file_id: str):
+    """
+    для больших файлов google drive вместо файла отдает страницу
+    "не удалось проверить на вирусы" с токеном подтверждения
+    """
+    # старый вариант: токен в cookie download_warning_*
+    for name, value in response.cookies.items():
+        if name.startswith('download_warning'):
+            return {'id': file_id, 'export': 'download', 'confirm': value}
+    
+    if not response.headers.get('Content-Type', '').startswith('text/html'):
+        return None
+    
+    # новый вариант: токен в скрытых полях html формы
+    html = response.text
+    confirm = re.search(r'name="confirm"\s+value="([^"]+)"', html)
+    if not confirm:
+        return None
+    params = {'id': file_id, 'export': 'download', 'confirm': confirm.group(1)}
+    uuid = re.search(r'name="uuid"\s+value="([^"]+)"', html)
+    if uuid:
+        params['uuid'] = uuid.group(1)
+    return params
 
 
 def download_from_google_drive(file_id: str, destination: Path):
@@ -36,11 +80,19 @@ def download_from_google_drive(file_id: str, destination: Path):
     print(f"[INFO] File ID: {file_id}")
     
     # Google Drive direct download URL
-    url = f"https://drive.google.com/uc?export=download&id={file_id}"
+    url = "https://drive.google.com/uc"
     
     try:
-        with DownloadProgressBar(unit='B', unit_scale=True, miniters=1, desc=destination.name) as t:
-            urllib.request.urlretrieve(url, destination, reporthook=t.update_to)
+        with requests.Session() as session:
+            response = session.get(url, params={'export': 'download', 'id': file_id},
+                                   stream=True, timeout=TIMEOUT)
+            confirm_params = _google_drive_confirm_params(response, file_id)
+            if confirm_params:
+                response.close()
+                response = session.get("https://drive.usercontent.google.com/download",
+                                       params=confirm_params, stream=True, timeout=TIMEOUT)
+            with response:
+                _save_stream(response, destination)
         return True
     except Exception as e:
         print(f"[ERROR] Ошибка при загрузке: {e}")
@@ -53,8 +105,8 @@ def download_from_direct_url(url: str, destination: Path):
     print(f"[INFO] URL: {url}")
     
     try:
-        with DownloadProgressBar(unit='B', unit_scale=True, miniters=1, desc=destination.name) as t:
-            urllib.request.urlretrieve(url, destination, reporthook=t.update_to)
+        with requests.get(url, stream=True, timeout=TIMEOUT) as response:
+            _save_stream(response, destination)
         return True
     except Exception as e:
         print(f"[ERROR] Ошибка при загрузке: {e}")
@@ -0,0 +1,53 @@
+"""
+регрессионные тесты regex части HybridBERTExtractor (bert не грузится)
+запуск из корня репозитория: python -m pytest -q tests
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from hybrid_bert_model import HybridBERTExtractor  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def extractor():
+    # только скомпилированные паттерны, без загрузки bert/classifier
+    ext = HybridBERTExtractor.__new__(HybridBERTExtractor)
+    ext._compile_patterns()
+    return ext
+
+
+@pytest.mark.parametrize("text, total", [
+    # целая сумма и сумма с копейками на соседних строках:
+    # у каждого варианта суммы свои совпадения, берется максимум по всем
+    ('ИТОГО 12 000\n7 500,00', '12000'),
+    ('К оплате: 350\n12,50 руб', '350'),
+    ('СУММА 1200\n3,00\n', '1200'),
+    ('ИТОГО\n1 500\n2 000,00', '1500'),
+    ('ИТОГО: 1 659 649,00 ₽', '1659649.00'),
+    ('Итого 2 600 ₽', '2600'),
+])
+def test_total_mixed_amounts(extractor, text, total):
+    assert extractor.extract_with_regex(text).get('total') == total
+
+
+@pytest.mark.parametrize("text, field, value", [
+    # соседние токены не должны съедать первое совпадение другого поля
+    ('14:19.01.02.2024Ф', 'date', '19.01.02'),
+    ('14:19.01.02.2024Ф', 'time', '14:19'),
+    ('01.02.24.03.2024', 'date', '24.03.2024'),
+    ('12:30:45.01.2024', 'time', '12:30:45'),
+    ('ИНН 1234567890 19.01.2024 14:19', 'inn', '1234567890'),
+    ('ИНН 1234567890 19.01.2024 14:19', 'date', '19.01.2024'),
+    ('.19.01.2024@mail.ru', 'date', '19.01.2024'),
+    ('.19.01.2024@mail.ru', 'email', '19.01.2024@mail.ru'),
+])
+def test_adjacent_fields(extractor, text, field, value):
+    assert extractor.extract_with_regex(text).get(field) == value